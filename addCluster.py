@@ -4,55 +4,13 @@ import os
 import sys
 import json
 import shutil
-import subprocess
-import time
 
 import helpers
+import packing
+import registry
+import submit
 
 
-def read_template(template):
-    """
-    read and return template file as JSON
-    """
-    data = None
-    with open(template) as data_file:
-        data = json.load(data_file)
-
-    return data
-
-def make_pod_from_template(temjson, case, docker2run):
-    """
-    given JSON from template, case to compute, and docker to run,
-    make in-memory pod json
-    """
-
-    pod = helpers.case2pod( case )
-
-    temjson["metadata"]["name"] = pod
-
-    temjson["spec"]["containers"][0]["name"] = pod
-
-    temjson["spec"]["containers"][0]["image"] = docker2run
-
-    temjson["spec"]["containers"][0]["args"]  = helpers.case2args(case)
-
-    return temjson
-
-
-def make_json_pod(template, case, docker2run):
-    """
-    from template and case to calc, make appropriate
-    """
-
-    temjson = read_template(template)
-    outjson = make_pod_from_template(temjson, case, docker2run)
-
-    fname = "pod" + "_" + helpers.case2name(case) + ".json"
-    with open(fname, "w+") as f:
-        f.write(json.dumps(outjson, indent=4))
-
-    return fname
-
 def read_config(ccfg):
     """
     read cluster configuration file from JSON
@@ -97,24 +55,30 @@ def main(cases_fname):
 
     print("Reading cases list from {0}".format(cases_fname))
 
-    cases = read_cases(cases_fname)
+    cases = [case for case in read_cases(cases_fname) if case]
 
     print("To compute Cases: {0}".format(len(cases)))
 
+    # pods sized the same way startCluster does
+    nof_threads = cfg.get("threads-per-pod")
+    if nof_threads is None:
+        nof_threads = max((helpers.case2threads(case) for case in cases), default = 1)
+    try:
+        p = packing.plan(mtype, 1, len(cases), nof_threads)
+    except ValueError as e:
+        print("Cannot plan pods: {0}".format(e))
+        return -1
+    print("Pods per node: {0}, each with {1} thread(s) and {2}m CPU".format(p["pods-per-node"], p["threads"], p["mcpu-per-pod"]))
+
+    cases = [helpers.set_case_threads(case, p["threads"]) for case in cases]
+
     docker2run = os.path.join(gcr, project, docker) # full path to docker
 
-    for case in cases:
-        pod_name = make_json_pod("colpod.json", case, docker2run)
-        cmd = "kubectl create -f " + pod_name
-        rc = 0
-        for k in range(0, 2): # several attempts to make a pod
-            rc = subprocess.call(cmd, shell=True)
-            if rc == 0:
-                time.sleep(0.5)
-                break
-
-        if rc != 0:
-            print("Cannot make case {0}".format(case))
+    failed = submit.submit_cases("colpod.json", cases, docker2run, p["mcpu-per-pod"])
+    for pod, err in sorted(failed.items()):
+        print("Cannot make case {0}: {1}".format(pod, err))
+
+    registry.record_submitted(cfg.get("registry", registry.REGISTRY), [case for case in cases if helpers.case2pod(case) not in failed])
 
     return 0
 
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import json
+import time
+import lzma
+import hashlib
+import tarfile
+import collections
+import concurrent.futures
+
+import helpers
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# codec to archive suffix
+SUFFIXES = {"xz": ".tar.xz", "zstd": ".tar.zst", "none": ".tar"}
+
+DEFAULT = {"codec": "xz", "level": 6, "threads": 0} # threads 0 means all available CPUs
+
+# dictionary size of xz presets, in bytes
+XZ_DICT_SIZES = [1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22, 1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26]
+
+ZSTD_WINDOW_LOG = 27 # long-range window, 128MiB, the default decompressor limit
+
+BUFFER_SIZE = 1024*1024 # read/write buffer size, in bytes
+
+# signature hash algorithms, signatures member is named after the algorithm
+SIGN_ALGOS = ("sha1", "sha256", "blake2b", "blake2s")
+
+HASH_KEY = "GEANT4ONGCE.hash" # pax header of the member telling its hash algorithm
+
+
+class SignatureError(Exception):
+    """
+    Archive member does not match its signature
+    """
+    pass
+
+
+# what reading a broken archive might raise
+ERRORS = (tarfile.TarError, lzma.LZMAError, EOFError, OSError, SignatureError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def nof_threads(threads):
+    """
+    Return number of compression threads, all available CPUs, within the cgroup quota, if threads is 0
+    """
+
+    if threads > 0:
+        return threads
+
+    return helpers.auto_threads()
+
+
+def strip_suffix(name):
+    """
+    Given archive name, return it without archive suffix, None if not an archive
+    """
+
+    for suffix in SUFFIXES.values():
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+
+    return None
+
+
+def codec_of(name):
+    """
+    Given archive name, return its codec, None if not an archive
+    """
+
+    for codec, suffix in SUFFIXES.items():
+        if name.endswith(suffix):
+            return codec
+
+    return None
+
+
+class ParallelXZWriter:
+    """
+    Writable stream compressing fixed-size blocks as independent xz streams
+    on a thread pool. Concatenated xz streams form a valid .xz file, readable
+    by xz, tar and lzma module alike. Memory is bounded by the number
+    of blocks in flight.
+    """
+
+    def __init__(self, fileobj, preset = 6, threads = 0):
+        self.fileobj = fileobj
+        self.preset  = preset
+        self.threads = nof_threads(threads)
+
+        # xz own multi-threaded mode uses blocks of 3 dictionaries
+        self.block_size = 3 * XZ_DICT_SIZES[min(preset & 0x1F, 9)]
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.threads)
+        self.pending  = collections.deque()
+        self.buf      = bytearray()
+        self.nof_in   = 0
+
+    def submit(self, block):
+        self.pending.append(self.executor.submit(lzma.compress, bytes(block), format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=self.preset))
+        while len(self.pending) > 2 * self.threads:
+            self.drain_one()
+
+    def drain_one(self):
+        self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buf += data
+        self.nof_in += len(data)
+        while len(self.buf) >= self.block_size:
+            self.submit(self.buf[:self.block_size])
+            del self.buf[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.buf or self.nof_in == 0:
+            self.submit(self.buf)
+            self.buf = bytearray()
+        while self.pending:
+            self.drain_one()
+        self.executor.shutdown()
+
+
+class CountingWriter:
+    """
+    Pass-through writable stream counting bytes written and time spent writing
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.nof_bytes = 0
+        self.seconds   = 0.0
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.fileobj.write(data)
+        self.seconds   += time.perf_counter() - start
+        self.nof_bytes += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def open_writer(fileobj, codec = "xz", level = 6, threads = 0):
+    """
+    Wrap binary file object into compressing writable stream
+
+    Parameters
+    ----------
+
+    fileobj: file object
+        where compressed data go
+
+    codec: string
+        "xz", "zstd" or "none"
+
+    level: int
+        compression level, xz preset or zstd level
+
+    threads: int
+        number of compression threads, 0 for all available CPUs
+
+    returns: object with write() and close()
+        compressing stream, closing it does not close fileobj
+    """
+
+    if codec == "xz":
+        return ParallelXZWriter(fileobj, level, threads)
+
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd codec needs zstandard package")
+
+        params = zstandard.ZstdCompressionParameters.from_level(level, threads = nof_threads(threads),
+                                                                enable_ldm = True, window_log = ZSTD_WINDOW_LOG)
+        return zstandard.ZstdCompressor(compression_params = params).stream_writer(fileobj, closefd = False)
+
+    if codec == "none":
+        return CountingWriter(fileobj)
+
+    raise ValueError("Unknown codec {0}".format(codec))
+
+
+class HashingReader:
+    """
+    Pass-through readable stream hashing everything read, timing the hashing
+    """
+
+    def __init__(self, fileobj, algo = "sha1"):
+        self.fileobj = fileobj
+        self.hasher  = hashlib.new(algo)
+        self.seconds = 0.0
+
+    def read(self, size = -1):
+        data  = self.fileobj.read(size)
+        start = time.perf_counter()
+        self.hasher.update(data)
+        self.seconds += time.perf_counter() - start
+        return data
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def stream_archive(fileobj, fnames, codec = "xz", level = 6, threads = 0, algo = "sha1", extra = None, stats = None):
+    """
+    Pack files into compressed archive written to a stream, hashing every
+    file while it is packed, so each file is read once. Signatures are
+    added as the last member, named after the hash algorithm, in main.sign format.
+    Every file member tells the algorithm in its pax header, so a reader
+    can verify it on the fly, before the signatures arrive.
+
+    Parameters
+    ----------
+
+    fileobj: file object
+        where compressed archive goes, e.g. upload stream
+
+    fnames: list of strings
+        files to pack
+
+    algo: string
+        hash algorithm
+
+    extra: list of tuples
+        member name and function returning its content as bytes, called
+        after files are packed, so content might describe the packing itself
+
+    stats: dictionary
+        if not None, "bytes-in" and "hash-seconds" are added to it
+
+    returns: list of tuples
+        file name, as packed, and its hash
+    """
+
+    hashl = list()
+
+    def add(info, f):
+        reader = HashingReader(f, algo)
+        info.pax_headers = {HASH_KEY: algo}
+        tar.addfile(info, reader)
+        hashl.append((info.name, reader.hexdigest()))
+        if stats is not None:
+            stats["bytes-in"]     = stats.get("bytes-in", 0) + info.size
+            stats["hash-seconds"] = stats.get("hash-seconds", 0.0) + reader.seconds
+
+    writer = open_writer(fileobj, codec, level, threads)
+    with tarfile.open(fileobj = writer, mode = "w|", bufsize = BUFFER_SIZE, format = tarfile.PAX_FORMAT) as tar:
+        for fname in fnames:
+            info = tar.gettarinfo(fname, arcname = os.path.basename(fname))
+            with open(fname, "rb") as f:
+                add(info, f)
+
+        for name, content in (extra or []):
+            data = content()
+            info = tarfile.TarInfo(name)
+            info.size  = len(data)
+            info.mtime = int(time.time())
+            add(info, io.BytesIO(data))
+
+        data = "".join("{0}: {1}\n".format(name, h) for name, h in hashl).encode("utf-8")
+        info = tarfile.TarInfo(algo)
+        info.size  = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+    writer.close()
+
+    return hashl
+
+
+def open_reader(fname):
+    """
+    Open archive as decompressed binary stream, codec chosen by suffix
+
+    Parameters
+    ----------
+
+    fname: string
+        archive file name
+
+    returns: file object
+        decompressed stream
+    """
+
+    codec = codec_of(fname)
+
+    if codec == "xz":
+        return lzma.open(fname, "rb") # handles concatenated streams
+
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd codec needs zstandard package")
+        dctx = zstandard.ZstdDecompressor(max_window_size = 1 << ZSTD_WINDOW_LOG)
+        return dctx.stream_reader(open(fname, "rb"), closefd = True)
+
+    if codec == "none":
+        return open(fname, "rb")
+
+    raise ValueError("Not an archive {0}".format(fname))
+
+
+def benchmark(fnames, configs):
+    """
+    Compress files with every configuration, measuring time and ratio
+
+    Parameters
+    ----------
+
+    fnames: list of strings
+        files to compress, typically real .output files
+
+    configs: list of dictionaries
+        codec, level and threads to try
+
+    returns: list of dictionaries
+        configuration with wall time, input and output bytes, ratio and MB/sec
+    """
+
+    results = list()
+    for cfg in configs:
+        start  = time.time()
+        nof_in = 0
+        with open(os.devnull, "wb") as f:
+            counter = CountingWriter(f)
+            writer  = open_writer(counter, cfg["codec"], cfg["level"], cfg.get("threads", 0))
+            for fname in fnames:
+                with open(fname, "rb") as src:
+                    for chunk in iter(lambda: src.read(BUFFER_SIZE), b""):
+                        writer.write(chunk)
+                        nof_in += len(chunk)
+            writer.close()
+        nof_out = counter.nof_bytes
+        elapsed = time.time() - start
+
+        r = dict(cfg)
+        r.update({"seconds": elapsed, "bytes-in": nof_in, "bytes-out": nof_out,
+                  "ratio": float(nof_in) / nof_out if nof_out > 0 else 0.0,
+                  "MB/sec": nof_in / elapsed / 1.0e6 if elapsed > 0 else 0.0})
+        results.append(r)
+
+    return results
+
+
+BENCH_CONFIGS = [ {"codec": "none", "level": 0},
+                  {"codec": "xz",   "level": 1},
+                  {"codec": "xz",   "level": 6},
+                  {"codec": "xz",   "level": 9},
+                  {"codec": "xz",   "level": 6, "threads": 1},
+                  {"codec": "zstd", "level": 3},
+                  {"codec": "zstd", "level": 10},
+                  {"codec": "zstd", "level": 19} ]
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args < 3 or sys.argv[1] != "bench":
+        print("Use: archive bench file.output ...")
+        sys.exit(1)
+
+    configs = [cfg for cfg in BENCH_CONFIGS if cfg["codec"] != "zstd" or zstandard is not None]
+
+    for r in benchmark(sys.argv[2:], configs):
+        print(json.dumps(r))
+
+    sys.exit(0)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+import synth
+import process_run
+import process_all
+
+NOF_RUNS    = 4
+NOF_RECORDS = 200000
+LEVEL       = 1 # compression level of generated archives, low to keep generation quick
+
+
+def peak_rss():
+    """
+    Return peak RSS of this process in KiB. VmHWM is preferred, as it
+    is reset by exec, while ru_maxrss keeps the peak of the parent
+    """
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def usage():
+    """
+    Return CPU seconds of this process and its finished children,
+    peak RSS in KiB of this process and of its largest child
+    """
+
+    me   = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return me.ru_utime + me.ru_stime + kids.ru_utime + kids.ru_stime, peak_rss(), kids.ru_maxrss
+
+
+def stage_process_output(fname):
+    g, e, p = process_run.process_output(fname)
+    return sum(len(q) for q in (g, e, p) if q is not None)
+
+
+def stage_process_archive(fname):
+    g, e, p, signs = process_run.process_archive(fname)
+    return sum(len(q) for q in (g, e, p) if q is not None)
+
+
+def stage_process_all(dir_name, nof_workers):
+    g, e, p, runs = process_all.process_all(dir_name, process_all.PATTERN, nof_workers)
+    return sum(len(q) for q in (g, e, p) if q is not None)
+
+
+STAGES = { "process_output":  stage_process_output,
+           "process_archive": stage_process_archive,
+           "process_all":     stage_process_all }
+
+
+def child(conn, stage, args):
+    """
+    Run stage in a fresh process and send back its measurements
+    """
+
+    start = time.time()
+    nof_records = STAGES[stage](*args)
+    elapsed = time.time() - start
+
+    cpu, rss, kids_rss = usage()
+    conn.send((nof_records, elapsed, cpu, rss, kids_rss))
+    conn.close()
+
+
+def measure(stage, args, nof_bytes):
+    """
+    Measure stage in a spawned process, so peak memory is its own
+
+    Parameters
+    ----------
+
+    stage: string
+        stage name, key of STAGES
+
+    args: tuple
+        stage arguments
+
+    nof_bytes: integer
+        bytes the stage consumes, uncompressed
+
+    returns: dictionary
+        stage, records, bytes, wall and CPU seconds, records/sec, MB/sec and peak RSS,
+        of the stage process and of its largest worker
+    """
+
+    ctx = multiprocessing.get_context("spawn")
+    parent, conn = ctx.Pipe(duplex = False)
+    p = ctx.Process(target = child, args = (conn, stage, args))
+    p.start()
+    conn.close()
+    nof_records, elapsed, cpu, rss, kids_rss = parent.recv()
+    p.join()
+
+    return { "stage":       stage,
+             "records":     nof_records,
+             "bytes":       nof_bytes,
+             "seconds":     elapsed,
+             "cpu-seconds": cpu,
+             "records/sec": nof_records / elapsed if elapsed > 0 else 0.0,
+             "MB/sec":      nof_bytes / elapsed / 1.0e6 if elapsed > 0 else 0.0,
+             "peak-rss-kb": rss,
+             "children-peak-rss-kb": kids_rss }
+
+
+def commit():
+    """
+    Return git commit of the tree, None if unknown
+    """
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)),
+                              stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, check = True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(nof_runs = NOF_RUNS, nof_records = NOF_RECORDS, workers = (1, 2, 4), wrk_dir = None):
+    """
+    Generate synthetic runs and measure every post-processing stage on them
+
+    Parameters
+    ----------
+
+    nof_runs: integer
+        number of synthetic runs
+
+    nof_records: integer
+        particle records per run
+
+    workers: tuple of integers
+        numbers of workers to try in process_all
+
+    wrk_dir: string
+        where to generate data, temporary directory if None
+
+    returns: dictionary
+        environment, suite parameters and per stage results
+    """
+
+    tmp = wrk_dir or tempfile.mkdtemp(prefix = "bench")
+    try:
+        runs = synth.make_runs(os.path.join(tmp, "runs"), nof_runs, nof_records, level = LEVEL)
+        total = sum(size for name, size, counts in runs)
+
+        output = os.path.join(tmp, "one.output")
+        synth.write_output(output, nof_records)
+
+        results = list()
+        results.append(measure("process_output", (output,), os.path.getsize(output)))
+        results.append(measure("process_archive", (os.path.join(tmp, "runs", runs[0][0]),), runs[0][1]))
+        for n in workers:
+            r = measure("process_all", (os.path.join(tmp, "runs"), n), total)
+            r["workers"] = n
+            results.append(r)
+    finally:
+        if wrk_dir is None:
+            shutil.rmtree(tmp)
+
+    return { "commit":   commit(),
+             "time":     time.strftime("%Y-%m-%dT%H:%M:%S"),
+             "python":   platform.python_version(),
+             "numpy":    np.__version__,
+             "cpus":     os.cpu_count(),
+             "runs":     nof_runs,
+             "records":  nof_records,
+             "results":  results }
+
+
+def compare(old, new):
+    """
+    Compare two suite results, stage by stage
+
+    returns: list of tuples
+        stage label, old and new records/sec and their ratio
+    """
+
+    def label(r):
+        return r["stage"] + ("/{0}".format(r["workers"]) if "workers" in r else "")
+
+    before = {label(r): r for r in old["results"]}
+
+    rows = list()
+    for r in new["results"]:
+        b = before.get(label(r))
+        if b is not None:
+            rows.append((label(r), b["records/sec"], r["records/sec"], r["records/sec"] / b["records/sec"] if b["records/sec"] > 0 else 0.0))
+
+    return rows
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args > 3 and sys.argv[1] == "compare":
+        with open(sys.argv[2]) as f:
+            old = json.load(f)
+        with open(sys.argv[3]) as f:
+            new = json.load(f)
+        for stage, a, b, ratio in compare(old, new):
+            print("{0}: {1:.0f} -> {2:.0f} records/sec, x{3:.2f}".format(stage, a, b, ratio))
+        sys.exit(0)
+
+    if nof_args < 2:
+        print("Use: bench results.json [number of runs] [records per run]")
+        print("     bench compare old.json new.json")
+        sys.exit(1)
+
+    nof_runs    = int(sys.argv[2]) if nof_args > 2 else NOF_RUNS
+    nof_records = int(sys.argv[3]) if nof_args > 3 else NOF_RECORDS
+
+    suite = run_suite(nof_runs, nof_records)
+    with open(sys.argv[1], "w") as f:
+        json.dump(suite, f, indent=4)
+
+    for r in suite["results"]:
+        print(json.dumps(r))
+
+    sys.exit(0)
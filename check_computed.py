@@ -1,28 +1,45 @@
 # -*- coding: utf-8 -*-
 
-with open("cases.txt", "rt+") as cases:
-    with open("TTT", "rt+") as computed:
-        inlines = cases.readlines()
-        bslines = computed.readlines()
-
-        for case in inlines:
-            case = case.rstrip()
-            s = case.split(" ")
-            s = [q for q in s if q] # remove empty strings
-
-            c = s[1]
-            n = s[2]
-            seed1 = s[4]
-            seed2 = s[5]
-
-            str = f"C{c}_{n}_1_({seed1},{seed2})"
-            #print(str)
-
-            found = False
-            for base in bslines:
-                if str in base:
-                    found = True
-                    break
-
-            if not found:
-                print(case)
+import sys
+
+import registry
+
+
+def main(cases_fname, computed):
+    """
+    Print cases from the list which have no computed results
+
+    Parameters
+    ----------
+
+    cases_fname: string
+        file name which contains list of cases
+
+    computed: string
+        listing of computed results, file or directory
+
+    returns: integer
+        number of missing cases
+    """
+
+    conn = registry.open_registry(":memory:")
+
+    with open(cases_fname, "rt") as cases:
+        inlines = [case.rstrip() for case in cases.readlines()]
+    registry.add_cases(conn, inlines)
+
+    registry.add_results(conn, registry.read_listing(computed))
+
+    names = set(registry.missing(conn))
+    for case in inlines:
+        if case and registry.parse_case(case)[0] in names:
+            print(case)
+
+    return len(names)
+
+
+if __name__ =='__main__':
+    cases_fname = sys.argv[1] if len(sys.argv) > 1 else "cases.txt"
+    computed    = sys.argv[2] if len(sys.argv) > 2 else "TTT"
+
+    main(cases_fname, computed)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in for the Geant4 col application, to run and time main.py offline.
+Reads the macro made by main.fix_macro and prints synthetic records at
+a configurable volume and rate. Behaviour is set by fakecol.json in the
+working directory, see DEFAULT.
+
+    fakecol.py setup <dir>                       make working directory with col, macro and local storage
+    fakecol.py sweep <dir> <C> <# of tracks> <records per track> ...
+                                                 time main.py at each output volume
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, HERE)
+
+import synth
+
+CONFIG = "fakecol.json"
+
+DEFAULT = { "records_per_track": 0.1, # particle records printed per track
+            "tracks_per_sec":    0,   # simulation speed, 0 for as fast as possible
+            "noise":             0.1, # Geant4 log lines per record
+            "stderr_lines":      10,  # lines printed to stderr
+            "rc":                0 }  # exit code
+
+BATCH_TRACKS = 10000 # tracks per batch when not rate limited
+
+MACRO = """/run/numberOfThreads 1
+/random/setSeeds 1 1
+/control/execute C25.in
+/run/beamOn 100
+"""
+
+
+def read_macro(fname):
+    """
+    Parse macro made by main.fix_macro
+
+    returns: dictionary
+        C, nof_tracks, nof_threads and seed
+    """
+
+    m = {"C": 25, "nof_tracks": 0, "nof_threads": 1, "seed": (1, 1)}
+
+    with open(fname, "rt") as f:
+        for line in f:
+            s = line.split()
+            if len(s) < 2:
+                continue
+            if s[0] == "/run/beamOn":
+                m["nof_tracks"] = int(s[1])
+            elif s[0] == "/run/numberOfThreads":
+                m["nof_threads"] = int(s[1])
+            elif s[0] == "/random/setSeeds" and len(s) > 2:
+                m["seed"] = (int(s[1]), int(s[2]))
+            elif s[0] == "/control/execute" and s[1].startswith("C") and s[1].endswith(".in"):
+                m["C"] = int(s[1][1:-3])
+
+    return m
+
+
+def read_config(fname = CONFIG):
+    """
+    Read configuration, defaults for whatever is missing
+    """
+
+    cfg = dict(DEFAULT)
+    if os.path.exists(fname):
+        with open(fname, "rt") as f:
+            cfg.update(json.load(f))
+
+    return cfg
+
+
+def emit(out, err, macro, cfg):
+    """
+    Print synthetic output of the run described by the macro
+
+    Parameters
+    ----------
+
+    out, err: binary file objects
+        stdout and stderr
+
+    macro: dictionary
+        run parameters, see read_macro
+
+    cfg: dictionary
+        configuration, see DEFAULT
+
+    returns: integer
+        number of records printed
+    """
+
+    rng  = np.random.default_rng(list(macro["seed"]))
+    nof_threads = max(1, macro["nof_threads"])
+    nof_tracks  = macro["nof_tracks"]
+    rpt  = cfg["records_per_track"]
+    rate = cfg["tracks_per_sec"]
+
+    for k in range(cfg["stderr_lines"]):
+        err.write("G4WT{0} > WARNING: synthetic stderr line {1}\n".format(k % nof_threads, k).encode("utf-8"))
+    err.flush()
+
+    out.write("### Run 0 starts, C{0}, {1} tracks, {2} threads\n".format(macro["C"], nof_tracks, nof_threads).encode("utf-8"))
+
+    batch = max(1, int(rate) // 10) if rate > 0 else BATCH_TRACKS
+
+    start = time.time()
+    done  = 0
+    nof_records = 0
+    while done < nof_tracks:
+        t = min(batch, nof_tracks - done)
+        n = int(round((done + t) * rpt)) - int(round(done * rpt))
+        if n > 0:
+            text, counts = synth.make_lines(rng, n, nof_threads, cfg["noise"])
+            out.write(text.encode("utf-8"))
+            out.flush()
+            nof_records += n
+        done += t
+
+        if rate > 0:
+            delay = start + done / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    out.write("G4WT0 > Run terminated.\n".encode("utf-8"))
+    out.flush()
+
+    return nof_records
+
+
+def setup(dir_name, mac = "batchGP5.mac"):
+    """
+    Make working directory for main.py with this stand-in as col,
+    a macro and local storage inside the directory
+    """
+
+    os.makedirs(dir_name, exist_ok=True)
+
+    app = os.path.join(dir_name, "col")
+    if not os.path.exists(app):
+        os.symlink(os.path.realpath(__file__), app)
+
+    with open(os.path.join(dir_name, mac), "wt") as f:
+        f.write(MACRO)
+
+    with open(os.path.join(dir_name, "config_local.json"), "wt") as f:
+        json.dump({"backend": "local", "root": os.path.join(os.path.abspath(dir_name), "store"), "dest": "runs"}, f, indent=4)
+
+    with open(os.path.join(dir_name, "run.json"), "wt") as f:
+        json.dump({"application": "col", "macro": mac, "credentials": "config_local.json"}, f, indent=4)
+
+
+def sweep(dir_name, C, nof_tracks, rpts, nof_threads = 1):
+    """
+    Run main.py in the working directory at every records per track value,
+    measuring wall time
+
+    returns: list of dictionaries
+        records per track, return code, seconds and output bytes
+    """
+
+    import main
+
+    results = list()
+    for rpt in rpts:
+        cfg = read_config(os.path.join(dir_name, CONFIG))
+        cfg["records_per_track"] = rpt
+        with open(os.path.join(dir_name, CONFIG), "wt") as f:
+            json.dump(cfg, f, indent=4)
+
+        start = time.time()
+        rc = subprocess.call([sys.executable, os.path.join(HERE, "main.py"), "run.json", str(C), str(nof_tracks), str(nof_threads), "1", "1"], cwd = dir_name)
+        elapsed = time.time() - start
+
+        output = os.path.join(dir_name, main.make_output_name("col", "batchGP5.mac", C, nof_tracks, nof_threads, (1, 1)))
+        nof_bytes = os.path.getsize(output) if os.path.exists(output) else 0
+
+        results.append({"records_per_track": rpt, "rc": rc, "seconds": elapsed, "output-bytes": nof_bytes,
+                        "MB/sec": nof_bytes / elapsed / 1.0e6 if elapsed > 0 else 0.0})
+
+    return results
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args > 2 and sys.argv[1] == "setup":
+        setup(sys.argv[2])
+        sys.exit(0)
+
+    if nof_args > 5 and sys.argv[1] == "sweep":
+        for r in sweep(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), [float(q) for q in sys.argv[5:]]):
+            print(json.dumps(r))
+        sys.exit(0)
+
+    if nof_args != 2:
+        print(__doc__)
+        sys.exit(1)
+
+    cfg = read_config()
+    emit(sys.stdout.buffer, sys.stderr.buffer, read_macro(sys.argv[1]), cfg)
+
+    sys.exit(cfg["rc"])
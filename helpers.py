@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import os
+import hashlib
+
+SEED_MAX = 2**31 - 1 # derived seeds are in [1, SEED_MAX)
+
+
 def case2name(case):
     """
     Convert case into name
@@ -26,3 +32,129 @@ def case2args(case):
     s = [q for q in s if q] # remove empty strings
     s[0] += ".json"
     return s
+
+
+def case2threads(case):
+    """
+    Return number of threads of the case
+    """
+    return int(case2args(case)[3])
+
+
+def set_case_threads(case, nof_threads):
+    """
+    Return case with number of threads replaced
+    """
+    s = case.split(" ")
+    s = [q for q in s if q] # remove empty strings
+    s[3] = str(nof_threads)
+    return " ".join(s)
+
+
+def cgroup_cpu_quota():
+    """
+    Return CPU quota of the container from cgroup v2 or v1
+
+    returns: float
+        number of CPUs the container may use, None if there is no quota
+    """
+
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "rt") as f:
+            quota, period = f.read().split()
+        if quota == "max":
+            return None
+        return float(quota) / float(period)
+    except (OSError, ValueError):
+        pass
+
+    for cpu_dir in ("/sys/fs/cgroup/cpu", "/sys/fs/cgroup/cpu,cpuacct"):
+        try:
+            with open(os.path.join(cpu_dir, "cpu.cfs_quota_us"), "rt") as f:
+                quota = int(f.read())
+            with open(os.path.join(cpu_dir, "cpu.cfs_period_us"), "rt") as f:
+                period = int(f.read())
+        except (OSError, ValueError):
+            continue
+
+        if quota <= 0 or period <= 0:
+            return None
+        return float(quota) / float(period)
+
+    return None
+
+
+def available_cpus():
+    """
+    Return number of CPUs actually available to the process,
+    taking into account affinity mask and cgroup quota
+
+    returns: float
+        number of CPUs, might be fractional
+    """
+
+    if hasattr(os, "sched_getaffinity"):
+        n = float(len(os.sched_getaffinity(0)))
+    else:
+        n = float(os.cpu_count() or 1)
+
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        n = min(n, quota)
+
+    return n
+
+
+def auto_threads():
+    """
+    Return number of threads matching available CPUs, at least one
+    """
+    return max(1, int(available_cpus() + 0.5))
+
+
+def chunk_seed(seed, k):
+    """
+    Derive seed pair of the chunk from the case seed, same for every restart
+
+    Parameters
+    ------------
+
+    seed: tuple of ints
+        RNG seed of the case
+
+    k: int
+        chunk index
+
+    returns: tuple of ints
+        RNG seed of the chunk
+    """
+
+    h = hashlib.sha256("{0},{1},{2}".format(seed[0], seed[1], k).encode("utf-8")).digest()
+    return (int.from_bytes(h[0:4], "little") % (SEED_MAX - 1) + 1, int.from_bytes(h[4:8], "little") % (SEED_MAX - 1) + 1)
+
+
+def make_chunks(nof_tracks, tracks_per_chunk, seed):
+    """
+    Split run into sub-runs of about equal size with derived seeds
+
+    Parameters
+    ------------
+
+    nof_tracks: int
+        number of tracks of the case
+
+    tracks_per_chunk: int
+        maximum number of tracks of the chunk, 0 for no split
+
+    seed: tuple of ints
+        RNG seed of the case
+
+    returns: list of tuples
+        number of tracks and seed of every chunk, the case itself if not split
+    """
+
+    if tracks_per_chunk <= 0 or nof_tracks <= tracks_per_chunk:
+        return [(nof_tracks, seed)]
+
+    n = (nof_tracks + tracks_per_chunk - 1) // tracks_per_chunk
+    return [(nof_tracks // n + (1 if k < nof_tracks % n else 0), chunk_seed(seed, k)) for k in range(n)]
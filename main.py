@@ -5,7 +5,45 @@ import os
 import subprocess
 import logging
 import json
-import hashlib
+import fnmatch
+import time
+import shutil
+import signal
+import multiprocessing
+
+import archive
+import helpers
+import metrics
+import registry
+import storage
+import workqueue
+
+CHUNK_SIZE = 1024*1024 # chunk size to stream application output to disk, in bytes
+
+AUTO_THREADS = 0 # number of threads meaning "as many as there are CPUs available"
+
+SCRATCH_DIR = "scratch" # where batch mode makes per-case work dirs
+
+# run products, not to be linked into scratch dirs
+PRODUCTS = ("*.output", "*.errors", "*.tar.xz", "*.rlog", "batch.mac", "sha1")
+
+TERMINATED = 128 + signal.SIGTERM # return code of the run stopped by SIGTERM
+
+_state = {"child": None, "stop": False, "killed": False} # running application, whether SIGTERM came and stopped it
+
+
+def on_sigterm(signum, frame):
+    """
+    Stop on SIGTERM, e.g. preemption: stop the application,
+    let upload in progress finish, run nothing new
+    """
+
+    _state["stop"] = True
+
+    p = _state["child"]
+    if p is not None and p.poll() is None:
+        p.terminate()
+        _state["killed"] = True
 
 def fix_macro_int(lines, key, value):
     """
@@ -117,7 +155,69 @@ def fix_macro(mac, C, nof_tracks, nof_threads, seed):
 
     return "batch.mac"
 
-def run(app, mac, C, nof_tracks, nof_threads, seed):
+def capture(cmd, out_name, err_name, chunk_size = CHUNK_SIZE, sink = None):
+    """
+    Run command, streaming its stdout and stderr to disk as they arrive
+
+    Parameters
+    ------------
+
+    cmd: list of strings
+        command to run
+
+    out_name: string
+        file name to write stdout to
+
+    err_name: string
+        file name to write stderr to
+
+    chunk_size: int
+        size of the chunk to copy stdout with, in bytes
+
+    sink: object with feed(chunk) and close()
+        sees every chunk of stdout as it comes and returns what is to be written, e.g. tally.Tally
+
+    returns: tuple
+        return code of the command, number of bytes written to stdout file
+    """
+
+    nof_bytes = 0
+    with open(out_name, "wb") as out_file, open(err_name, "wb") as err_file:
+        # stderr goes straight to the file, stdout is pumped in fixed-size chunks
+        p = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = err_file, bufsize = 0)
+        _state["child"] = p
+
+        fd = p.stdout.fileno()
+        while True:
+            chunk = os.read(fd, chunk_size)
+            if not chunk:
+                break
+            if sink is not None:
+                chunk = sink.feed(chunk)
+            out_file.write(chunk)
+            nof_bytes += len(chunk)
+
+        if sink is not None:
+            chunk = sink.close()
+            out_file.write(chunk)
+            nof_bytes += len(chunk)
+
+        p.stdout.close()
+        rc = p.wait()
+        _state["child"] = None
+
+    return (rc, nof_bytes)
+
+def make_output_name(app, mac, C, nof_tracks, nof_threads, seed):
+    """
+    Make file name of the stdout output for a given run
+
+    returns: string
+        file name of the stdout output
+    """
+    return app + "_" + mac + "_" + "C{0}".format(C) + "_" + str(nof_tracks) + "_" +  str(nof_threads) + "_" + "({0},{1})".format(seed[0], seed[1]) + ".output"
+
+def run(app, mac, C, nof_tracks, nof_threads, seed, sink = None):
     """
     Run application with macro as its first argument
 
@@ -137,187 +237,229 @@ def run(app, mac, C, nof_tracks, nof_threads, seed):
         number of tracks to run
 
     nof_threads: int
-        number of threads to run
+        number of threads to run, AUTO_THREADS to match available CPUs
 
     seed: tuple of int
         RNG seed
 
-    returns: string
-        file name of the stdout output
+    sink: object with feed(chunk) and close()
+        stdout stage, see capture
+
+    returns: tuple
+        file name of the stdout output, file name of the stderr output, macro, return code of the application
     """
 
+    if nof_threads == AUTO_THREADS:
+        nof_threads = helpers.auto_threads()
+        logging.info("Available CPUs {0}, auto # of threads {1}".format(helpers.available_cpus(), nof_threads))
+
     logging.info("Running app {0} wih the macro {1}: {2} {3} {4} {5}".format(app, mac, C, nof_tracks, nof_threads, seed) )
 
     macro = fix_macro(mac, C, nof_tracks, nof_threads, seed)
     if macro is None:
-        return (None, None)
-
-    cmd = [os.path.join(".", app), macro]
-    p = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        return (None, None, None, None)
 
-    std_out, std_err = p.communicate()
+    fname = make_output_name(app, mac, C, nof_tracks, nof_threads, seed)
+    ename = os.path.splitext(fname)[0] + ".errors"
 
-    fname = app + "_" + mac + "_" + "C{0}".format(C) + "_" + str(nof_tracks) + "_" +  str(nof_threads) + "_" + "({0},{1})".format(seed[0], seed[1]) + ".output"
-    with open(fname, "w") as the_file:
-        the_file.write(std_out)
+    cmd = [os.path.join(".", app), macro]
+    start = time.time()
+    rc, nof_bytes = capture(cmd, fname, ename, sink = sink)
+    elapsed = time.time() - start
 
-    logging.info("Done with run")
-    return (fname, macro)
+    logging.info("Done with run: rc {0}, {1} bytes of output".format(rc, nof_bytes))
+    logging.info("Run time {0:.1f} s with {1} threads, {2:.1f} tracks/sec".format(elapsed, nof_threads, nof_tracks / elapsed if elapsed > 0 else 0.0))
+    return (fname, ename, macro, rc)
 
-def read_credentials(creds):
+def pipeline(creds, tarname, fnames, compression = None, algo = "sha1", extra = None, stage = None):
     """
-    Given the JSON credentials, return tuple with relevant info
+    Sign, pack, compress and upload everything outgoing in a single pass
+
+    Parameters
+    ------------
 
     creds: string
-        JSON file with credentials
+        JSON file with storage configuration
+
+    tarname: string
+        name of the archive to make, without suffix
+
+    fnames: list of strings
+        files to pack
+
+    compression: dictionary
+        codec, level and threads, see archive.DEFAULT
+
+    algo: string
+        signature hash algorithm, one of archive.SIGN_ALGOS
+
+    extra: list of tuples
+        member name and function making its content, packed after files, see archive.stream_archive
+
+    stage: metrics.Stage
+        if not None, bytes in and out, hashing and upload seconds are set to its values
 
     returns: tuple
-        host, port, user, pswd, dest
+        return code, 0 on success, and archive name
     """
 
-    data = None
-    with open(creds) as json_file:
-        data = json.load(json_file)
+    cfg = dict(archive.DEFAULT)
+    if compression is not None:
+        cfg.update(compression)
 
-    host = data["host"]
-    port = data["port"]
-    user = data["user"]
-    pswd = data["pswd"]
-    dest = data["dest"]
+    if algo not in archive.SIGN_ALGOS:
+        logging.error("Unknown signature algorithm {0}".format(algo))
+        return (-1, None)
 
-    return (host, port, user, pswd, dest)
+    dst = tarname + archive.SUFFIXES[cfg["codec"]]
 
+    logging.info("Start streaming {0} with {1}".format(dst, cfg))
 
-def upload_data(creds, tarname):
-    """
-    Upload data to the server using SFTP
+    stats = stage.values if stage is not None else None
 
-    Parameters
-    ------------
+    try:
+        with storage.open_storage(creds).open_upload(dst) as f:
+            counter = archive.CountingWriter(f)
+            hashl = archive.stream_archive(counter, fnames, cfg["codec"], cfg["level"], cfg["threads"], algo, extra, stats)
+    except Exception as e: # storage client errors are not OSErrors
+        logging.error("Streaming upload failed: {0}".format(e))
+        return (-1, None)
 
-    creds: string
-        JSON file with credentials
+    if stats is not None:
+        stats["bytes-out"]      = counter.nof_bytes
+        stats["upload-seconds"] = counter.seconds
 
-    tarname: string
-        TAR archive to create
+    for fname, h in hashl:
+        logging.info("Signed {0}: {1}".format(fname, h))
 
-    returns: string
-        file name of the stdout output
-    """
-    from google.cloud import storage
+    logging.info("Done streaming {0}".format(dst))
 
-    rc = 0
+    return (0, dst)
 
-    logging.info("Start data uploading [GSTOR]")
 
-    try:
-        host, port, user, pswd, dest = read_credentials(creds)
+def done_chunks(creds, app, mac, C):
+    """
+    Return keys of runs already in the storage, number of threads left out,
+    as it might differ between restarts on different nodes
 
-        storage_client = storage.Client.from_service_account_json(user)
-        bucket         = storage_client.get_bucket(pswd)
+    returns: set of tuples
+        C, number of tracks and seeds of every run found
+    """
 
-        blob = bucket.blob(os.path.join(dest, tarname))
-        blob.upload_from_filename(tarname)
+    prefix = app + "_" + mac + "_C{0}_".format(C)
 
-        rc = 0
+    try:
+        names = storage.open_storage(creds).list(prefix)
+    except Exception as e: # storage client errors are not OSErrors
+        logging.error("Cannot list {0}: {1}".format(prefix, e))
+        return set()
 
-    except OSError:
-        logging.debug("upload_sftp: OS failure ")
-        rc = -1
-        return rc
+    done = set()
+    for name in names:
+        key = registry.parse_archive(name)
+        if key is not None:
+            done.add((key[0], key[1], key[3], key[4]))
 
-    return rc
+    return done
 
-def sign(*fnames):
+
+def main(cfg_json, C, nof_tracks, nof_threads, seed, keep = True):
     """
-    Compute hash functions of the downloaded cups, to be
-    used as a signature
+    Run app using configuration from JSON and # of tracks. With
+    "tracks-per-chunk" in configuration the run is split into chunks,
+    each uploaded when done, chunks already in the storage are skipped.
 
     Parameters
     ------------
 
-    fnames: list
-        file names to sign
+    cfg_json: string
+        JSON file name with configuration
 
-    returns: string
-        file name of file with signatures
-    """
+    C: int
+        collimator, in mm
 
-    logging.info("Start data signing")
+    nof_tracks: int
+        # of tracks to compute, actual would be 10 times more
 
-    algo = "sha1"
+    nof_threads: int
+        # of threads to run, AUTO_THREADS (0) to match available CPUs
 
-    if not (algo in hashlib.algorithms):
-        raise Exception("data_uploader", "No SHA1 hash available")
+    seed: tuple of ints
+        RNG seed
 
-    hashl = []
+    keep: bool
+        if False, remove local output and archive after the upload
 
-    # everything in work.dir: input, phantom, cups, etc
-    for fname in fnames:
+    returns: int
+        return code, 0 on success, TERMINATED if stopped by SIGTERM, non-zero on failure
+    """
 
-        hasher = hashlib.sha1()
+    wrk_dir = os.getcwd()
+    data = None
+    with open(cfg_json) as data_file:
+        data = json.load(data_file)
+
+    app = data["application"]
+    mac = data["macro"]
+    crd = data["credentials"]
 
-        ctx = fname
-        with open(ctx, "rb") as afile:
-            buf = afile.read()
-            hasher.update(buf)
+    log = app + ".rlog"
 
-            hashl.append((ctx, hasher.hexdigest()))
+    # configuring logging, fresh log for every run
+    logging.basicConfig(filename=os.path.join(wrk_dir, log), filemode="w", level=logging.DEBUG, force=True)
+    logging.info("Started")
 
-    with open(algo, "wt") as f:
-        for l in hashl:
-            f.write(l[0])
-            f.write(": ")
-            f.write(l[1])
-            f.write("\n")
+    logging.info("Running JSON {0} with C{1},  # of tracks {2} and # of threads {3} and Rseed {4}".format(cfg_json, C, nof_tracks, nof_threads, seed))
 
-    logging.info("Done data signing")
+    # stop is not cleared, SIGTERM that came before this run, e.g. in between cases, still holds
+    _state["killed"] = False
+    signal.signal(signal.SIGTERM, on_sigterm)
 
-    return algo
+    if _state["stop"]:
+        logging.warning("Terminated before the run")
+        return TERMINATED
 
-def compress_data(tarname, *fnames):
-    """
-    Pack and compress everything outgoing
+    chunks = helpers.make_chunks(nof_tracks, data.get("tracks-per-chunk", 0), seed)
+    if len(chunks) == 1:
+        return run_upload(data, C, nof_tracks, nof_threads, seed, keep)
 
-    :param arcname: name of the archive to make
-    :type arcname: str
-    :param fnames: files to compress
-    :type fnames: list of str
-    """
+    done = done_chunks(crd, app, mac, C)
 
-    signs = sign(*fnames)
+    for k, (tracks, cseed) in enumerate(chunks):
+        if _state["stop"]:
+            break
 
-    dst = tarname + ".tar.xz"
+        if (C, tracks, cseed[0], cseed[1]) in done:
+            logging.info("Chunk {0} of {1} is done: {2} {3}".format(k + 1, len(chunks), tracks, cseed))
+            continue
 
-    cmd = ["tar", "-cvJSf", dst]
-    for fname in fnames:
-        cmd.append(fname)
-    cmd.append(signs)
+        logging.info("Chunk {0} of {1}: {2} {3}".format(k + 1, len(chunks), tracks, cseed))
+        rc = run_upload(data, C, tracks, nof_threads, cseed, keep)
+        if rc != 0:
+            return rc
 
-    rc = subprocess.call(cmd,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    if rc != 0:
-        return (rc, None)
+    if _state["stop"]:
+        logging.warning("Terminated, remaining chunks are left for restart")
+        return TERMINATED
 
-    return (rc, dst)
+    return 0
 
 
-def main(cfg_json, C, nof_tracks, nof_threads, seed):
+def run_upload(data, C, nof_tracks, nof_threads, seed, keep = True):
     """
-    Run app using configuration from JSON and # of tracks
+    Run app once and upload its products
 
     Parameters
     ------------
 
-    cfg_json: string
-        JSON file name with configuration
+    data: dictionary
+        configuration
 
     C: int
         collimator, in mm
 
     nof_tracks: int
-        # of tracks to compute, actual would be 10 times more
+        # of tracks to compute
 
     nof_threads: int
         # of threads to run
@@ -325,47 +467,258 @@ def main(cfg_json, C, nof_tracks, nof_threads, seed):
     seed: tuple of ints
         RNG seed
 
+    keep: bool
+        if False, remove local output after the upload
+
     returns: int
-        return code, 0 on success, non-zero on failure
+        return code, 0 on success, TERMINATED if stopped by SIGTERM, non-zero on failure
     """
 
-    wrk_dir = os.getcwd()
-    data = None
-    with open(cfg_json) as data_file:
-        data = json.load(data_file)
-
     app = data["application"]
     mac = data["macro"]
     crd = data["credentials"]
 
     log = app + ".rlog"
 
-    # configuring logging
-    logging.basicConfig(filename=os.path.join(wrk_dir, log), level=logging.DEBUG)
-    logging.info("Started")
+    mtr = metrics.Metrics(application = app, macro = mac, C = C, nof_tracks = nof_tracks, nof_threads = nof_threads,
+                          seed = list(seed) if seed is not None else None, cpus = helpers.available_cpus())
 
-    logging.info("Running JSON {0} with C{1},  # of tracks {2} and # of threads {3} and Rseed {4}".format(cfg_json, C, nof_tracks, nof_threads, seed))
+    # optional tally stage, histograms particles as they are printed
+    tly = None
+    tcfg = data.get("tally")
+    if tcfg is not None:
+        import tally
+        tly = tally.Tally(tally.make_edges(tcfg.get("bins")), keep_records = tcfg.get("records", True))
 
-    output, macro = run(app, mac, C, nof_tracks, nof_threads, seed)
+    with mtr.stage("run") as stage:
+        output, errors, macro, app_rc = run(app, mac, C, nof_tracks, nof_threads, seed, sink = tly)
     if output == None:
         return 1
 
-    rc, tarname = compress_data(output, output, macro, log)
-    if tarname == None:
-        return rc
+    if _state["killed"]:
+        # number of tracks behind partial output is unknown, it cannot be weighted, so it is not uploaded
+        logging.warning("Terminated, partial output {0} is not uploaded".format(output))
+        return TERMINATED
+
+    if app_rc != 0:
+        # crashed or killed application, e.g. OOM, leaves partial output of unknown number of tracks
+        logging.error("Application failed with {0}, partial output {1} is not uploaded".format(app_rc, output))
+        return app_rc if app_rc > 0 else 128 - app_rc
+
+    seconds = stage.record()["seconds"]
+    stage.values["bytes-out"]  = os.path.getsize(output)
+    stage.values["tracks/sec"] = nof_tracks / seconds if seconds > 0 else 0.0
+
+    products = [output, errors]
+    if tly is not None:
+        with mtr.stage("tally"):
+            tname = os.path.splitext(output)[0] + tally.SUFFIX
+            tly.save(tname)
+        products.append(tname)
+
+    # metrics go into the archive after everything else, with pipeline stage so far,
+    # and next to the output once the upload is done
+    mname = os.path.splitext(output)[0] + metrics.SUFFIX
+    with mtr.stage("pipeline") as stage:
+        rc, tarname = pipeline(crd, output, products + [macro, log], compression = data.get("compression"), algo = data.get("signature", "sha1"),
+                               extra = [(os.path.basename(mname), mtr.dumps)], stage = stage)
+    mtr.save(mname)
+
+    for s in mtr.record()["stages"]:
+        logging.info("Stage {0}: {1:.1f} s wall, {2:.1f} s CPU, {3:.1f} s children CPU".format(s["stage"], s["seconds"], s["cpu-seconds"], s["children-cpu-seconds"]))
+
+    if not keep:
+        for fname in products:
+            os.remove(fname)
+
+    return rc
+
+
+def worker(spec, lease_time = workqueue.LEASE_TIME):
+    """
+    Pull cases from the work queue and run them one after another until the queue is empty or SIGTERM comes
 
-    rc = upload_data(crd, tarname)
+    Parameters
+    ------------
+
+    spec: string
+        work queue, directory or http(s) URL
+
+    lease_time: float
+        lease time of the case, in seconds, renewed while the case is running
+
+    returns: int
+        number of failed cases
+    """
+
+    queue = workqueue.open_queue(spec)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    nof_failed = 0
+    while True:
+        if _state["stop"]:
+            break # SIGTERM came, nothing new is leased
+
+        task = queue.lease(lease_time)
+        if task is None:
+            break
+
+        task_id, case = task
+        s = helpers.case2args(case)
+
+        with workqueue.Heartbeat(queue, task_id, lease_time):
+            try:
+                rc = main(s[0], int(s[1]), int(s[2]), int(s[3]), (int(s[4]), int(s[5])), keep = False)
+            except Exception:
+                logging.exception("Case {0} failed".format(case))
+                rc = -1
+
+        if rc == TERMINATED:
+            break # lease expires and the case, resumed from its last chunk, goes to another worker
+
+        if rc == 0:
+            queue.complete(task_id)
+        else:
+            queue.fail(task_id)
+            nof_failed += 1
+
+    return nof_failed
+
+
+def make_scratch(src_dir, wrk_dir):
+    """
+    Make work dir with links to everything the application needs from the source dir
+
+    Parameters
+    ------------
+
+    src_dir: string
+        directory with application, macro, configs and inputs
+
+    wrk_dir: string
+        work dir to make
+    """
+
+    if os.path.isdir(wrk_dir):
+        shutil.rmtree(wrk_dir)
+    os.makedirs(wrk_dir)
+
+    for name in os.listdir(src_dir):
+        if any(fnmatch.fnmatch(name, q) for q in PRODUCTS) or name == SCRATCH_DIR:
+            continue
+        os.symlink(os.path.join(src_dir, name), os.path.join(wrk_dir, name))
+
+
+def run_case(args):
+    """
+    Run single case in its own work dir, to be used as a pool worker
+
+    Parameters
+    ------------
+
+    args: tuple
+        case, source dir, work dir, number of threads for auto-threaded cases
+
+    returns: int
+        return code, 0 on success
+    """
+
+    case, src_dir, wrk_dir, nof_threads = args
+
+    make_scratch(src_dir, wrk_dir)
+    os.chdir(wrk_dir) # pool runs every case in a fresh process
+
+    s = helpers.case2args(case)
+    threads = int(s[3])
+    if threads == AUTO_THREADS:
+        threads = nof_threads
+
+    try:
+        rc = main(s[0], int(s[1]), int(s[2]), threads, (int(s[4]), int(s[5])), keep = False)
+    except Exception:
+        logging.exception("Case {0} failed".format(case))
+        rc = -1
+
+    os.chdir(src_dir)
+    if rc == 0:
+        shutil.rmtree(wrk_dir) # keep failed ones for inspection
 
     return rc
 
 
+def batch(cases, nof_workers = None):
+    """
+    Run cases concurrently, each in its own work dir under SCRATCH_DIR
+
+    Parameters
+    ------------
+
+    cases: list of strings
+        cases in cases.txt format
+
+    nof_workers: int
+        number of cases running at once, number of available CPUs if None
+
+    returns: list of tuples
+        case and its return code
+    """
+
+    cases = [case for case in cases if case]
+
+    if nof_workers is None:
+        nof_workers = helpers.auto_threads()
+
+    # auto-threaded cases share available CPUs among concurrent ones
+    nof_threads = max(1, helpers.auto_threads() // nof_workers)
+
+    src_dir = os.getcwd()
+    args = [(case, src_dir, os.path.join(src_dir, SCRATCH_DIR, helpers.case2name(case)), nof_threads) for case in cases]
+
+    pool = multiprocessing.Pool(nof_workers, maxtasksperchild = 1)
+    try:
+        rcs = pool.map(run_case, args, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return list(zip(cases, rcs))
+
+
 if __name__ == '__main__':
     argc = len(sys.argv)
 
     if argc == 1:
-        print("Usage: main.py run.json <collimator size in mm> <number of tracks> <number of threads> <RNG pair of seeds>")
+        print("Usage: main.py run.json <collimator size in mm> <number of tracks> <number of threads or auto> <RNG pair of seeds>")
+        print("       main.py queue <queue directory or URL>")
+        print("       main.py batch cases.txt <number of cases running at once>")
         sys.exit(0)
 
+    if sys.argv[1] == "batch":
+        if argc < 3:
+            print("No cases")
+            sys.exit(16)
+
+        with open(sys.argv[2], "rt") as f:
+            cases = [x.strip() for x in f.readlines()]
+
+        nof_workers = int(sys.argv[3]) if argc > 3 else None
+
+        rc = 0
+        for case, crc in batch(cases, nof_workers):
+            if crc != 0:
+                print("Case {0} failed with {1}".format(case, crc))
+                rc = 1
+        sys.exit(rc)
+
+    if sys.argv[1] == "queue":
+        if argc < 3:
+            print("No queue")
+            sys.exit(15)
+
+        rc = worker(sys.argv[2])
+        sys.exit(1 if rc > 0 else 0)
+
     run_json = ""
     try:
         run_json = sys.argv[1]
@@ -393,8 +746,8 @@ if __name__ == '__main__':
 
     nof_threads = -1
     try:
-        nof_threads = int(sys.argv[4])
-        if nof_threads <= 0:
+        nof_threads = AUTO_THREADS if sys.argv[4] == "auto" else int(sys.argv[4])
+        if nof_threads < 0:
             raise ValueError("No # of threads")
     except:
         print("No # of threads")
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import resource
+import contextlib
+
+SUFFIX = ".metrics.json"
+
+
+def usage():
+    """
+    Return wall clock, CPU seconds and peak RSS of this process and of its waited for children
+
+    returns: dictionary
+        resource usage snapshot
+    """
+
+    me   = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return { "wall":                 time.time(),
+             "cpu":                  me.ru_utime + me.ru_stime,
+             "children-cpu":         kids.ru_utime + kids.ru_stime,
+             "peak-rss-kb":          me.ru_maxrss,
+             "children-peak-rss-kb": kids.ru_maxrss }
+
+
+class Stage:
+    """
+    Resource usage of a stage of the run, with values like bytes in and out
+    set by the stage. Peak RSS is the peak so far, it only grows over stages.
+    """
+
+    def __init__(self, name):
+        self.name   = name
+        self.start  = usage()
+        self.end    = None
+        self.values = dict()
+
+    def stop(self):
+        self.end = usage()
+
+    def record(self):
+        """
+        Return stage record, of the stage so far if it is not over yet
+        """
+
+        end = self.end if self.end is not None else usage()
+
+        r = { "stage":                self.name,
+              "seconds":              end["wall"] - self.start["wall"],
+              "cpu-seconds":          end["cpu"] - self.start["cpu"],
+              "children-cpu-seconds": end["children-cpu"] - self.start["children-cpu"],
+              "peak-rss-kb":          end["peak-rss-kb"],
+              "children-peak-rss-kb": end["children-peak-rss-kb"] }
+
+        if self.end is None:
+            r["partial"] = True
+
+        r.update(self.values)
+        return r
+
+
+class Metrics:
+    """
+    Per stage metrics of the run, saved as JSON record
+    """
+
+    def __init__(self, **info):
+        self.info   = info
+        self.stages = list()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure stage of the run, yields Stage to set values to
+        """
+
+        s = Stage(name)
+        self.stages.append(s)
+        try:
+            yield s
+        finally:
+            s.stop()
+
+    def record(self):
+        r = dict(self.info)
+        r["stages"] = [s.record() for s in self.stages]
+        return r
+
+    def dumps(self):
+        return json.dumps(self.record(), indent=4).encode("utf-8")
+
+    def save(self, fname):
+        """
+        Atomically save metrics record
+        """
+
+        with open(fname + ".tmp", "wb") as f:
+            f.write(self.dumps())
+        os.replace(fname + ".tmp", fname)
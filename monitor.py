@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import calendar
+import subprocess
+
+import helpers
+
+INTERVAL = 10.0 # seconds between polls
+
+STATES = ("completed", "running", "pending", "failed", "preempted", "missing")
+
+# pod and condition reasons telling the node went away under the pod
+PREEMPT_REASONS = ("Shutdown", "NodeShutdown", "Terminated", "NodeLost", "Evicted",
+                   "TerminationByKubelet", "PreemptionByScheduler", "DeletionByTaintManager")
+
+
+def fetch_pods(source = None):
+    """
+    Fetch all pods in one bulk call
+
+    Parameters
+    ------------
+
+    source: string
+        file with recorded "kubectl get pods -o json" response, kubectl is called if None
+
+    returns: dictionary
+        parsed pod list
+    """
+
+    if source is not None:
+        with open(source) as f:
+            return json.load(f)
+
+    out = subprocess.run(["kubectl", "get", "pods", "-o", "json"], stdout = subprocess.PIPE, check = True).stdout
+    return json.loads(out.decode("utf-8"))
+
+
+def parse_time(stamp):
+    """
+    Convert RFC 3339 UTC time stamp to seconds since epoch, None if no stamp
+    """
+
+    if not stamp:
+        return None
+
+    return float(calendar.timegm(time.strptime(stamp, "%Y-%m-%dT%H:%M:%SZ")))
+
+
+def container_state(pod):
+    """
+    Return state of the pod container, empty if none yet
+    """
+
+    statuses = pod.get("status", {}).get("containerStatuses") or [{}]
+    return statuses[0].get("state", {})
+
+
+def pod_state(pod):
+    """
+    Classify pod into one of STATES
+    """
+
+    status = pod.get("status", {})
+    phase  = status.get("phase")
+
+    if phase == "Succeeded":
+        return "completed"
+
+    if phase == "Running":
+        return "running"
+
+    if phase == "Failed":
+        if status.get("reason") in PREEMPT_REASONS:
+            return "preempted"
+        for cond in status.get("conditions") or []:
+            if cond.get("type") == "DisruptionTarget" and cond.get("status") == "True":
+                return "preempted"
+        return "failed"
+
+    return "pending"
+
+
+def pod_times(pod):
+    """
+    Return start and finish times of the pod container, None if unknown
+    """
+
+    state = container_state(pod)
+
+    if "terminated" in state:
+        return parse_time(state["terminated"].get("startedAt")), parse_time(state["terminated"].get("finishedAt"))
+
+    if "running" in state:
+        return parse_time(state["running"].get("startedAt")), None
+
+    return None, None
+
+
+def latest_time(pods):
+    """
+    Return latest time stamp seen in the pod list, "now" of a recorded response
+    """
+
+    latest = 0.0
+    for pod in pods["items"]:
+        for t in pod_times(pod) + (parse_time(pod.get("metadata", {}).get("creationTimestamp")),):
+            if t is not None:
+                latest = max(latest, t)
+
+    return latest
+
+
+def pod_key(name):
+    """
+    Return pod name with the number of threads left out, as startCluster
+    and addCluster rewrite it in cases before naming pods
+    """
+
+    s = name.split("-")
+    return "-".join(s[:-3] + s[-2:])
+
+
+def make_cases(cases):
+    """
+    Map pod keys, see pod_key, to number of tracks of their cases
+    """
+
+    return {pod_key(helpers.case2pod(case)): int(helpers.case2args(case)[2]) for case in cases if case}
+
+
+def summarize(pods, cases, now):
+    """
+    Join pods with cases and estimate throughput and time to finish
+
+    Throughput per pod is measured over completed pods, running pods are
+    assumed to be that far along, cluster throughput is it times running pods.
+    Pods report no progress of their own, so until the first pod completes
+    throughput and ETA are unknown. ETA covers running and pending pods only,
+    failed, preempted and missing cases have to be resubmitted first.
+
+    Parameters
+    ------------
+
+    pods: dictionary
+        parsed "kubectl get pods -o json" response
+
+    cases: dictionary
+        pod key to number of tracks, see make_cases
+
+    now: float
+        current time, seconds since epoch
+
+    returns: dictionary
+        counts per state, pod names per state, keys of missing ones, tracks done and total,
+        tracks/sec per pod and of the cluster, tracks left out of ETA,
+        ETA in seconds, None if unknown
+    """
+
+    names = {state: list() for state in STATES}
+
+    done_tracks    = 0
+    done_seconds   = 0.0
+    pending_tracks = 0
+    running        = list() # (tracks, seconds running)
+
+    seen = set()
+    for pod in pods["items"]:
+        name = pod.get("metadata", {}).get("name")
+        key  = pod_key(name) if name else None
+        if key not in cases:
+            continue
+        seen.add(key)
+
+        state = pod_state(pod)
+        names[state].append(name)
+
+        start, finish = pod_times(pod)
+        if state == "completed":
+            done_tracks += cases[key]
+            if start is not None and finish is not None:
+                done_seconds += finish - start
+        elif state == "running":
+            running.append((cases[key], max(0.0, now - start) if start is not None else 0.0))
+        elif state == "pending":
+            pending_tracks += cases[key]
+
+    names["missing"] = sorted(key for key in cases if key not in seen)
+
+    total = sum(cases.values())
+
+    per_pod = done_tracks / done_seconds if done_seconds > 0 else 0.0
+    partial = sum(min(tracks, per_pod * seconds) for tracks, seconds in running)
+
+    running_tracks = sum(tracks for tracks, seconds in running)
+
+    throughput = per_pod * len(names["running"])
+    remaining  = running_tracks - partial + pending_tracks
+
+    return { "counts":      {state: len(names[state]) for state in STATES},
+             "names":       names,
+             "tracks-done": done_tracks + partial,
+             "tracks":      total,
+             "tracks/sec per pod": per_pod,
+             "tracks/sec":  throughput,
+             "tracks-out":  total - done_tracks - running_tracks - pending_tracks,
+             "eta":         remaining / throughput if throughput > 0 else None }
+
+
+def format_summary(s):
+    """
+    Format summary as one line of the report
+    """
+
+    eta = "unknown"
+    if s["counts"]["completed"] == 0 and s["counts"]["running"] > 0:
+        eta = "unknown until the first pod completes"
+    elif s["eta"] is not None:
+        eta = time.strftime("%H:%M:%S", time.gmtime(s["eta"]))
+        if s["eta"] >= 86400:
+            eta = "{0}d {1}".format(int(s["eta"] // 86400), eta)
+        if s["tracks-out"] > 0:
+            eta += " ({0} tracks of failed, preempted and missing not included)".format(s["tracks-out"])
+
+    counts = " ".join("{0} {1}".format(state, s["counts"][state]) for state in STATES)
+    return "{0} | {1:.1f}% | {2:.0f} tracks/sec | ETA {3}".format(counts, 100.0 * s["tracks-done"] / s["tracks"] if s["tracks"] > 0 else 0.0, s["tracks/sec"], eta)
+
+
+def watch(cases, interval = INTERVAL, source = None):
+    """
+    Poll pods and print progress until no pod of the campaign is running or pending
+
+    Parameters
+    ------------
+
+    cases: list of strings
+        cases of the campaign
+
+    interval: float
+        seconds between polls
+
+    source: string
+        recorded response to report on once, kubectl is polled if None
+
+    returns: dictionary
+        last summary
+    """
+
+    cases = make_cases(cases)
+
+    while True:
+        pods = fetch_pods(source)
+        now  = latest_time(pods) if source is not None else time.time()
+
+        s = summarize(pods, cases, now)
+        print(time.strftime("%H:%M:%S") + " " + format_summary(s), flush = True)
+
+        if source is not None or s["counts"]["running"] + s["counts"]["pending"] == 0:
+            return s
+
+        time.sleep(interval)
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args < 2:
+        print("Use: monitor cases.txt [interval in seconds] [recorded pods JSON]")
+        sys.exit(1)
+
+    with open(sys.argv[1]) as f:
+        cases = [x.strip() for x in f.readlines()]
+
+    interval = float(sys.argv[2]) if nof_args > 2 else INTERVAL
+    source   = sys.argv[3] if nof_args > 3 else None
+
+    s = watch(cases, interval, source)
+
+    for state in ("failed", "preempted"):
+        for name in s["names"][state]:
+            print("{0}: {1}".format(state, name))
+
+    sys.exit(0)
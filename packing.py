@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+SYSTEM_MCPU = 100 # millicores taken by system daemon pods on every node, kube-proxy and friends
+
+# shared-core machine types have no vCPU count in their names, they burst over
+# a fraction of a core and GKE keeps about a core allocatable, so they are planned as one
+SHARED_CORE_CPUS = {"e2-micro": 1, "e2-small": 1, "e2-medium": 1, "f1-micro": 1, "g1-small": 1}
+
+
+def machine_cpus(mach_type):
+    """
+    Given GCE machine type, return number of vCPUs
+
+    Parameters
+    ------------
+
+    mach_type: string
+        machine type, like n1-highcpu-2, custom-4-3840 or e2-medium
+
+    returns: integer
+        number of vCPUs
+    """
+
+    if mach_type in SHARED_CORE_CPUS:
+        return SHARED_CORE_CPUS[mach_type]
+
+    s = mach_type.split("-")
+    try:
+        if s[0] == "custom" or (len(s) > 1 and s[1] == "custom"):
+            return int(s[s.index("custom") + 1])
+
+        return int(s[-1])
+    except (ValueError, IndexError):
+        raise ValueError("Unknown machine type {0}".format(mach_type))
+
+
+def allocatable_mcpu(cpus):
+    """
+    Given number of vCPUs, return millicores allocatable to pods,
+    following GKE reservation: 6% of the first core, 1% of the next one,
+    0.5% of the next two and 0.25% of any core above four
+
+    Parameters
+    ------------
+
+    cpus: integer
+        number of vCPUs of the node
+
+    returns: integer
+        allocatable millicores, less system daemons
+    """
+
+    reserved = 0.0
+    for k in range(cpus):
+        if k == 0:
+            reserved += 60.0
+        elif k == 1:
+            reserved += 10.0
+        elif k < 4:
+            reserved += 5.0
+        else:
+            reserved += 2.5
+
+    return int(cpus * 1000 - math.ceil(reserved)) - SYSTEM_MCPU
+
+
+def plan(mach_type, nof_nodes, nof_cases, nof_threads):
+    """
+    Pack cases onto nodes so that every node's cores are used
+    by one Geant4 thread each, and size pods accordingly
+
+    Parameters
+    ------------
+
+    mach_type: string
+        machine type
+
+    nof_nodes: integer
+        number of nodes in the cluster
+
+    nof_cases: integer
+        number of cases to compute
+
+    nof_threads: integer
+        number of threads per pod, capped by number of vCPUs
+
+    returns: dictionary
+        pod sizing and expected utilisation
+    """
+
+    cpus    = machine_cpus(mach_type)
+    threads = max(1, min(nof_threads, cpus))
+    alloc   = allocatable_mcpu(cpus)
+
+    pods_per_node = cpus // threads
+    mcpu_per_pod  = alloc // pods_per_node
+
+    slots = pods_per_node * nof_nodes
+    waves = int(math.ceil(nof_cases / float(slots))) if nof_cases > 0 else 0
+
+    return { "cpus":          cpus,
+             "threads":       threads,
+             "allocatable":   alloc,
+             "pods-per-node": pods_per_node,
+             "mcpu-per-pod":  mcpu_per_pod,
+             "slots":         slots,
+             "waves":         waves,
+             # share of the node cores running Geant4 threads while all slots are busy
+             "core-utilisation": float(pods_per_node * threads) / cpus,
+             # share of allocatable CPU granted to the pods
+             "cpu-utilisation":  float(pods_per_node * mcpu_per_pod) / alloc,
+             # share of slots busy over the whole campaign, last wave might be partial
+             "campaign-utilisation": float(nof_cases) / (waves * slots) if waves > 0 else 0.0 }
+
+
+def report(p):
+    """
+    Print packing plan
+    """
+
+    print("Node vCPUs: {0}, allocatable: {1}m".format(p["cpus"], p["allocatable"]))
+    print("Pods per node: {0}, each with {1} thread(s) and {2}m CPU".format(p["pods-per-node"], p["threads"], p["mcpu-per-pod"]))
+    print("Concurrent pods: {0}, waves: {1}".format(p["slots"], p["waves"]))
+    print("Expected utilisation: cores {0:.0%}, allocatable CPU {1:.0%}, over the campaign {2:.0%}".format(p["core-utilisation"], p["cpu-utilisation"], p["campaign-utilisation"]))
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import multiprocessing
+
+import numpy as np
+
+import phsf
+import archive
+import registry
+import process_run
+
+WEIGHT = "w"     # weight field, per primary of the whole merged phase space
+KEY    = "e"     # field merged phase spaces are sorted by
+BUDGET = 1 << 22 # records buffered at once over all inputs of the merge
+
+PARTS = ".parts" # suffix of the directory keeping per-run partial phase spaces
+
+
+def weighted_dtype(precision = "double"):
+    """
+    Make record dtype with weight, weight is always double, as per primary
+    weights of large campaigns are below half precision range
+    """
+
+    dtype = phsf.make_dtype(precision)
+    return np.dtype([(f, dtype.fields[f][0]) for f in dtype.names] + [(WEIGHT, "<f8")])
+
+
+def primaries_of(header):
+    """
+    Return number of primaries behind the phase space, from the header
+    or, for plain process_all output, summed over its run names. Older
+    process_all output listed runs which failed too, it is refused
+    """
+
+    if "primaries" in header:
+        return int(header["primaries"])
+
+    if not header.get("runs-read"):
+        raise ValueError("Runs of the phase space might include failed ones, cannot tell number of primaries")
+
+    total = 0
+    for run in header["runs"]:
+        key = registry.parse_archive(run)
+        if key is None:
+            raise ValueError("Cannot tell number of primaries of run {0}".format(run))
+        total += key[1]
+
+    return total
+
+
+def run2partial(dir_name, run_name, out_name, precision = "double", key = KEY):
+    """
+    Convert run archive into phase space weighted per its primaries and sorted by key
+
+    Parameters
+    ----------
+
+    dir_name: string
+        directory with run archives
+
+    run_name: string
+        run archive name, number of primaries is parsed from it
+
+    out_name: string
+        partial phase-space file name
+
+    returns: dictionary
+        header written, None if the run failed
+    """
+
+    parsed = registry.parse_archive(run_name)
+    if parsed is None:
+        raise ValueError("Not a run name {0}".format(run_name))
+    nof_tracks = parsed[1]
+
+    g, e, p, signs = process_run.read_run(dir_name, run_name)
+    if signs is None:
+        return None # failed, a readable run might have no photons at all
+
+    plain = phsf.make_dtype(precision)
+    parts = dict()
+    for (name, tag), lines in zip(phsf.PARTICLES, (g, e, p)):
+        a = phsf.lines2array(lines, tag, plain)
+        if key is not None:
+            a = a[np.argsort(a[key], kind="stable")]
+        parts[name] = a
+
+    meta = {"primaries": nof_tracks, "sorted": key}
+
+    header, arrays = phsf.create_phsf(out_name + ".tmp", parts, weighted_dtype(precision), [run_name], meta)
+    for name, a in parts.items():
+        out = arrays[name]
+        for f in plain.names:
+            out[f] = a[f]
+        out[WEIGHT] = 1.0 / nof_tracks
+        if isinstance(out, np.memmap):
+            out.flush()
+    del arrays
+
+    os.replace(out_name + ".tmp", out_name)
+    return header
+
+
+def convert(block, dtype, factor):
+    """
+    Convert block of input records to output dtype, weights scaled by factor
+    """
+
+    out = np.empty(len(block), dtype=dtype)
+    for f in dtype.names:
+        if f != WEIGHT:
+            out[f] = block[f]
+    out[WEIGHT] = block[WEIGHT] * factor if WEIGHT in block.dtype.names else factor
+
+    return out
+
+
+def merge_block(sources, out, key, step):
+    """
+    Merge particle blocks of inputs into output block, k-way by key if
+    key is not None, otherwise one after another
+
+    Parameters
+    ----------
+
+    sources: list of tuples
+        input array of records and its weight factor
+
+    out: numpy array
+        output array, memory-mapped, of the total length
+
+    key: string
+        field inputs are sorted by, None to concatenate
+
+    step: integer
+        records read from every input at once
+    """
+
+    dtype = out.dtype
+
+    if key is None:
+        pos = 0
+        for a, factor in sources:
+            for start in range(0, len(a), step):
+                block = convert(a[start:start + step], dtype, factor)
+                out[pos:pos + len(block)] = block
+                pos += len(block)
+        return
+
+    # every input has a buffer, records up to the smallest last key of buffers
+    # are final, as everything still unread is not below its buffer last key
+    starts = [0] * len(sources)
+    bufs   = [None] * len(sources)
+
+    def refill(k):
+        a, factor = sources[k]
+        bufs[k] = convert(a[starts[k]:starts[k] + step], dtype, factor) if starts[k] < len(a) else None
+        starts[k] += step
+
+    for k in range(len(sources)):
+        refill(k)
+
+    pos = 0
+    while True:
+        active = [k for k in range(len(sources)) if bufs[k] is not None]
+        if not active:
+            break
+
+        threshold = min(bufs[k][key][-1] for k in active)
+
+        parts = list()
+        for k in active:
+            n = np.searchsorted(bufs[k][key], threshold, side="right")
+            parts.append(bufs[k][:n])
+            bufs[k] = bufs[k][n:]
+            if len(bufs[k]) == 0:
+                refill(k)
+
+        merged = np.concatenate(parts)
+        merged = merged[np.argsort(merged[key], kind="stable")]
+        out[pos:pos + len(merged)] = merged
+        pos += len(merged)
+
+
+def merge(out_name, inputs, key = KEY, precision = "double", budget = BUDGET):
+    """
+    Merge phase spaces into one weighted per primary of all of them.
+    Memory is bounded by budget records whatever the inputs size. Inputs
+    might be per-run partials, plain process_all output or earlier
+    merges, output might be one of the inputs, it is replaced on success.
+
+    Parameters
+    ----------
+
+    out_name: string
+        merged phase-space file name
+
+    inputs: list of strings
+        binary phase-space files
+
+    key: string
+        field to sort by, inputs must be sorted by it, None to concatenate
+
+    precision: string
+        precision of the output record fields
+
+    budget: integer
+        records buffered at once over all inputs
+
+    returns: dictionary
+        header written
+    """
+
+    opened = [phsf.read_phsf(fname, mmap = True) for fname in inputs]
+
+    for fname, (header, arrays) in zip(inputs, opened):
+        if key is not None and header.get("sorted") != key:
+            raise ValueError("{0} is not sorted by {1}".format(fname, key))
+
+    nof_prims = [primaries_of(header) for header, arrays in opened]
+    total = sum(nof_prims)
+
+    # inputs with weights are per their own primaries, rescale to the total
+    factors = list()
+    for (header, arrays), n in zip(opened, nof_prims):
+        factors.append(float(n) / total if WEIGHT in header["fields"] else 1.0 / total)
+
+    runs   = [run for header, arrays in opened for run in header["runs"]]
+    counts = {name: sum(header["counts"][name] for header, arrays in opened) for name, tag in phsf.PARTICLES}
+    meta   = {"primaries": total, "sorted": key}
+    step   = max(1024, budget // max(1, len(inputs)))
+
+    header, out = phsf.create_phsf(out_name + ".tmp", counts, weighted_dtype(precision), runs, meta)
+    for name, tag in phsf.PARTICLES:
+        if counts[name] > 0:
+            sources = [(arrays[name], factor) for (h, arrays), factor in zip(opened, factors)]
+            merge_block(sources, out[name], key, step)
+            out[name].flush()
+    del out, opened
+
+    os.replace(out_name + ".tmp", out_name)
+    return header
+
+
+def partial_one(args):
+    """
+    Convert single run into partial phase space, to be used as a pool worker
+
+    returns: string
+        partial file name, None if the run failed
+    """
+
+    dir_name, run_name, parts_dir, precision, key = args
+
+    out_name = os.path.join(parts_dir, archive.strip_suffix(run_name) + ".phsf")
+    if run2partial(dir_name, run_name, out_name, precision, key) is None:
+        return None
+
+    return out_name
+
+
+def merge_runs(dir_name, out_name, nof_workers = 1, key = KEY, precision = "double"):
+    """
+    Merge runs of the directory into the merged phase space, only runs
+    not merged yet are read, so it might be called as runs arrive
+
+    returns: list of strings
+        names of the runs merged by this call
+    """
+
+    done = set()
+    if os.path.exists(out_name):
+        done = set(phsf.read_header(out_name)["runs"])
+
+    names = sorted(q for q in os.listdir(dir_name) if archive.codec_of(q) is not None and q not in done)
+    if not names:
+        return []
+
+    parts_dir = out_name + PARTS
+    os.makedirs(parts_dir, exist_ok=True)
+
+    tasks = [(dir_name, name, parts_dir, precision, key) for name in names]
+    if nof_workers <= 1:
+        parts = [partial_one(t) for t in tasks]
+    else:
+        with multiprocessing.Pool(nof_workers) as pool:
+            parts = pool.map(partial_one, tasks)
+
+    merged = [name for name, part in zip(names, parts) if part is not None]
+    parts  = [part for part in parts if part is not None]
+    if not parts:
+        return []
+
+    inputs = ([out_name] if done else []) + parts
+    merge(out_name, inputs, key, precision)
+
+    for part in parts:
+        os.remove(part)
+
+    return merged
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args < 3:
+        print("Use: phmerge merged.phsf <dir with run archives> [workers] [double|single|half]")
+        print("     phmerge merged.phsf -m input.phsf ...")
+        sys.exit(1)
+
+    if sys.argv[2] == "-m":
+        header = merge(sys.argv[1], sys.argv[3:])
+        print("{0} runs, {1} primaries".format(len(header["runs"]), header["primaries"]))
+        sys.exit(0)
+
+    nof_workers = int(sys.argv[3]) if nof_args > 3 else 1
+    precision   = sys.argv[4] if nof_args > 4 else "double"
+
+    merged = merge_runs(sys.argv[2], sys.argv[1], nof_workers, precision = precision)
+    print("{0} runs merged".format(len(merged)))
+
+    sys.exit(0)
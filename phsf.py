@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC   = b"PHSF"
+VERSION = 1
+ALIGN   = 64 # every particle block starts at an offset aligned to this, in bytes
+
+# particle tags as printed by Geant4 application, in the order of blocks in the file
+PARTICLES = (("photons", "GGG"), ("electrons", "EEE"), ("positrons", "PPP"))
+
+# fields of the phase-space record, in the order they are printed after the tag
+FIELDS = ("e", "x", "y", "z", "wx", "wy", "wz")
+
+PRECISIONS = {"double": "<f8", "single": "<f4", "half": "<f2"}
+
+
+def make_dtype(precision = "double", fields = FIELDS):
+    """
+    Make structured dtype for the phase-space record
+
+    Parameters
+    ----------
+
+    precision: string
+        one of "double", "single" or "half"
+
+    fields: tuple of strings
+        names of the record fields
+
+    returns: numpy.dtype
+        structured dtype of the record
+    """
+
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision {0}".format(precision))
+
+    return np.dtype([(f, PRECISIONS[precision]) for f in fields])
+
+
+def parse_line(line, tag, nof_fields = len(FIELDS)):
+    """
+    Given text line with a particle, return its fields as tuple of floats
+
+    Parameters
+    ----------
+
+    line: string
+        line from the Geant4 output
+
+    tag: string
+        particle tag, GGG, EEE or PPP
+
+    returns: tuple of floats
+        record fields
+    """
+
+    s = line[line.index(tag) + len(tag):].split()
+    if len(s) < nof_fields:
+        raise ValueError("Not enough fields in line {0}".format(line))
+
+    return tuple(float(q) for q in s[:nof_fields])
+
+
+def parse_lines(lines, tag, nof_fields = len(FIELDS)):
+    """
+    Parse record lines in one go, falling back to per line parsing,
+    which skips malformed lines, if the number of fields is off
+
+    Parameters
+    ----------
+
+    lines: list of strings or bytes
+        text lines with particles
+
+    tag: string
+        particle tag, GGG, EEE or PPP
+
+    returns: numpy array
+        records, 2D with nof_fields float64 columns
+    """
+
+    if not lines:
+        return np.empty((0, nof_fields), dtype=np.float64)
+
+    binary = isinstance(lines[0], bytes)
+    t = tag.encode("ascii") if binary else tag
+
+    # loadtxt parses in C and raises on any line with extra, missing or non-numeric fields
+    try:
+        a = np.loadtxt([line.partition(t)[2] for line in lines], dtype=np.float64, ndmin=2)
+        if a.shape[1] == nof_fields:
+            return a
+    except ValueError:
+        pass
+
+    rows = list()
+    for line in lines:
+        try:
+            rows.append(parse_line(line.decode("ascii", "replace") if binary else line, tag, nof_fields))
+        except ValueError:
+            pass
+
+    return np.array(rows, dtype=np.float64).reshape(-1, nof_fields)
+
+
+def lines2array(lines, tag, dtype):
+    """
+    Convert text lines with particles into array of records
+
+    Parameters
+    ----------
+
+    lines: list of strings
+        text lines, might be None
+
+    tag: string
+        particle tag, GGG, EEE or PPP
+
+    dtype: numpy.dtype
+        structured dtype of the record
+
+    returns: numpy array
+        array of records, malformed lines are skipped
+    """
+
+    if lines is None:
+        return np.empty(0, dtype=dtype)
+
+    a = parse_lines(lines, tag, len(dtype.names))
+
+    records = np.empty(len(a), dtype=dtype)
+    for k, name in enumerate(dtype.names):
+        records[name] = a[:, k]
+
+    return records
+
+
+def aligned(offset):
+    """
+    Round offset up to the block alignment
+    """
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def make_header(arrays, dtype, runs, meta = None):
+    """
+    Make header describing the file layout
+
+    Parameters
+    ----------
+
+    arrays: dictionary
+        particle name to array of records, or to number of records
+
+    dtype: numpy.dtype
+        structured dtype of the record
+
+    runs: list of strings
+        names of the source runs
+
+    meta: dictionary
+        extra header entries, might be None
+
+    returns: dictionary
+        header, with offsets of blocks counted from the file start
+    """
+
+    counts = {name: int(len(v)) if hasattr(v, "__len__") else int(v) for name, v in arrays.items()}
+
+    header = { "version": VERSION,
+               "fields":  list(dtype.names),
+               "dtype":   [[name, dtype.fields[name][0].str] for name in dtype.names],
+               "counts":  {name: counts[name] for name, tag in PARTICLES},
+               "runs":    list(runs) if runs is not None else [],
+               "offsets": {} }
+
+    if meta is not None:
+        header.update(meta)
+
+    # offsets depend on the header size, iterate until it is stable
+    hsize = 0
+    while True:
+        offset = aligned(len(MAGIC) + 8 + hsize)
+        for name, tag in PARTICLES:
+            header["offsets"][name] = offset
+            offset = aligned(offset + counts[name] * dtype.itemsize)
+
+        size = len(json.dumps(header).encode("utf-8"))
+        if size == hsize:
+            break
+        hsize = size
+
+    return header
+
+
+def write_header(f, header):
+    """
+    Write magic and header at the file start
+    """
+
+    hdata = json.dumps(header).encode("utf-8")
+
+    f.write(MAGIC)
+    f.write(struct.pack("<Q", len(hdata)))
+    f.write(hdata)
+
+
+def write_phsf(fname, photons, electrons, positrons, runs = None, precision = "double", meta = None):
+    """
+    Write phase-space in binary format
+
+    Parameters
+    ----------
+
+    fname: string
+        output file name
+
+    photons, electrons, positrons: list of strings or numpy arrays
+        text lines from the Geant4 output or arrays of records, might be None
+
+    runs: list of strings
+        names of the source runs
+
+    precision: string
+        one of "double", "single" or "half"
+
+    meta: dictionary
+        extra header entries, might be None
+
+    returns: dictionary
+        header written
+    """
+
+    dtype = make_dtype(precision)
+
+    arrays = dict()
+    for (name, tag), data in zip(PARTICLES, (photons, electrons, positrons)):
+        if isinstance(data, np.ndarray):
+            arrays[name] = data.astype(dtype)
+        else:
+            arrays[name] = lines2array(data, tag, dtype)
+
+    header = make_header(arrays, dtype, runs, meta)
+
+    with open(fname, "wb") as f:
+        write_header(f, header)
+        for name, tag in PARTICLES:
+            f.write(b"\0" * (header["offsets"][name] - f.tell()))
+            arrays[name].tofile(f)
+
+    return header
+
+
+def create_phsf(fname, counts, dtype, runs = None, meta = None):
+    """
+    Create binary phase-space file of known size, to be filled in place,
+    so it can be written without holding the records in memory
+
+    Parameters
+    ----------
+
+    fname: string
+        output file name
+
+    counts: dictionary
+        particle name to number of records
+
+    dtype: numpy.dtype
+        structured dtype of the record
+
+    runs: list of strings
+        names of the source runs
+
+    meta: dictionary
+        extra header entries, might be None
+
+    returns: tuple
+        header, dictionary of particle name to writable memory-mapped array
+    """
+
+    header = make_header(counts, dtype, runs, meta)
+
+    with open(fname, "wb") as f:
+        write_header(f, header)
+        name = PARTICLES[-1][0]
+        f.truncate(header["offsets"][name] + header["counts"][name] * dtype.itemsize)
+
+    arrays = dict()
+    for name, tag in PARTICLES:
+        count = header["counts"][name]
+        if count > 0:
+            arrays[name] = np.memmap(fname, dtype=dtype, mode="r+", offset=header["offsets"][name], shape=(count,))
+        else:
+            arrays[name] = np.empty(0, dtype=dtype)
+
+    return header, arrays
+
+
+def read_header(fname):
+    """
+    Read header of the binary phase-space file
+
+    Parameters
+    ----------
+
+    fname: string
+        phase-space file name
+
+    returns: dictionary
+        header
+    """
+
+    with open(fname, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError("Not a binary phase-space file: {0}".format(fname))
+
+        hsize, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(hsize).decode("utf-8"))
+
+    if header["version"] > VERSION:
+        raise ValueError("Unsupported phase-space file version {0}".format(header["version"]))
+
+    return header
+
+
+def header_dtype(header):
+    """
+    Make record dtype from the header
+    """
+    return np.dtype([(name, t) for name, t in header["dtype"]])
+
+
+def read_phsf(fname, mmap = False):
+    """
+    Read phase-space in binary format
+
+    Parameters
+    ----------
+
+    fname: string
+        phase-space file name
+
+    mmap: boolean
+        if True, memory-map the particle blocks instead of reading them
+
+    returns: tuple
+        header, dictionary of particle name to array of records
+    """
+
+    header = read_header(fname)
+    dtype  = header_dtype(header)
+
+    arrays = dict()
+    with open(fname, "rb") as f:
+        for name, tag in PARTICLES:
+            count  = header["counts"][name]
+            offset = header["offsets"][name]
+            if mmap and count > 0:
+                arrays[name] = np.memmap(fname, dtype=dtype, mode="r", offset=offset, shape=(count,))
+            else:
+                f.seek(offset)
+                arrays[name] = np.fromfile(f, dtype=dtype, count=count)
+
+    return header, arrays
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+import numpy as np
+
+import phsf
+
+CHUNK = 65536 # records per chunk of the weight table used in weighted sampling
+
+
+class Source:
+    """
+    Phase-space source over memory-mapped binary phase-space file.
+    Records are never loaded all at once, only pages touched by samples
+    and batches are read, and those pages are shared by every process
+    mapping the same file. Pickled sources reopen the file, so they can
+    be handed to pool workers.
+    """
+
+    def __init__(self, fname, particles = None, weight = None, seed = None):
+        """
+        Parameters
+        ----------
+
+        fname: string
+            binary phase-space file
+
+        particles: list of strings
+            particle names to sample from, all if None
+
+        weight: string
+            field used as record weight, uniform sampling if None
+
+        seed: integer
+            random seed, None for fresh entropy
+        """
+
+        self.fname     = fname
+        self.particles = particles
+        self.weight    = weight
+        self.seed      = seed
+        self.open()
+
+    def open(self):
+        self.header, arrays = phsf.read_phsf(self.fname, mmap = True)
+
+        self.kinds  = list()
+        self.blocks = list()
+        for k, (name, tag) in enumerate(phsf.PARTICLES):
+            if self.particles is None or name in self.particles:
+                self.kinds.append(k)
+                self.blocks.append(arrays[name])
+
+        self.starts = np.cumsum([0] + [len(a) for a in self.blocks])
+        self.rng    = np.random.default_rng(self.seed)
+        self.table  = None
+
+        if self.weight is not None and self.weight not in self.header["fields"]:
+            raise ValueError("No weight field {0} in {1}".format(self.weight, self.fname))
+
+    def __getstate__(self):
+        return {"fname": self.fname, "particles": self.particles, "weight": self.weight, "seed": self.seed}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def take(self, idx):
+        """
+        Return records at sorted global indices
+
+        returns: tuple
+            particle index in phsf.PARTICLES per record, array of records
+        """
+
+        kinds   = list()
+        records = list()
+        bounds  = np.searchsorted(idx, self.starts)
+        for k, a in enumerate(self.blocks):
+            local = idx[bounds[k]:bounds[k + 1]] - self.starts[k]
+            if len(local) > 0:
+                kinds.append(np.full(len(local), self.kinds[k], dtype=np.int8))
+                records.append(np.asarray(a[local]))
+
+        if not records:
+            return np.empty(0, dtype=np.int8), np.empty(0, dtype=phsf.header_dtype(self.header))
+
+        return np.concatenate(kinds), np.concatenate(records)
+
+    def weight_table(self):
+        """
+        Return global index bounds and total weight of every chunk,
+        made on first use by one pass over the weight field
+        """
+
+        if self.table is None:
+            bounds = list()
+            sums   = list()
+            for a, s in zip(self.blocks, self.starts):
+                for start in range(0, len(a), CHUNK):
+                    bounds.append((s + start, s + min(start + CHUNK, len(a))))
+                    sums.append(float(a[self.weight][start:start + CHUNK].sum(dtype=np.float64)))
+            self.table = (np.array(bounds, dtype=np.int64).reshape(-1, 2), np.array(sums, dtype=np.float64))
+
+        return self.table
+
+    def sample(self, n):
+        """
+        Draw n records at random with replacement, uniformly or
+        with probability proportional to the weight field
+
+        returns: tuple
+            particle index in phsf.PARTICLES per record, array of records
+        """
+
+        if len(self) == 0:
+            raise ValueError("Nothing to sample in {0}".format(self.fname))
+
+        if self.weight is None:
+            idx = np.sort(self.rng.integers(0, len(self), n))
+        else:
+            # pick chunks by their total weight, then records within chunk by their weight
+            bounds, sums = self.weight_table()
+            per_chunk = self.rng.multinomial(n, sums / sums.sum())
+            idx = list()
+            for c in np.nonzero(per_chunk)[0]:
+                lo, hi = bounds[c]
+                kinds, records = self.take(np.arange(lo, hi))
+                cdf = np.cumsum(records[self.weight], dtype=np.float64)
+                idx.append(lo + np.searchsorted(cdf, self.rng.uniform(0.0, cdf[-1], per_chunk[c]), side="right"))
+            idx = np.sort(np.concatenate(idx))
+
+        # records are read in file order, then shuffled
+        kinds, records = self.take(idx)
+        order = self.rng.permutation(len(records))
+        return kinds[order], records[order]
+
+    def batches(self, size, part = 0, nof_parts = 1):
+        """
+        Iterate over records in file order, in batches. Readers with
+        different part get disjoint contiguous shares of the file.
+
+        Parameters
+        ----------
+
+        size: integer
+            records per batch
+
+        part: integer
+            share to read, from 0 to nof_parts-1
+
+        nof_parts: integer
+            number of shares
+
+        returns: generator of tuples
+            particle index in phsf.PARTICLES per record, array of records
+        """
+
+        lo = len(self) * part // nof_parts
+        hi = len(self) * (part + 1) // nof_parts
+        for start in range(lo, hi, size):
+            yield self.take(np.arange(start, min(start + size, hi)))
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args < 3:
+        print("Use: phsource PHSF.bin <number of samples> [weight field] [seed]")
+        sys.exit(1)
+
+    weight = sys.argv[3] if nof_args > 3 and sys.argv[3] != "none" else None
+    seed   = int(sys.argv[4]) if nof_args > 4 else None
+
+    src = Source(sys.argv[1], weight = weight, seed = seed)
+    kinds, records = src.sample(int(sys.argv[2]))
+
+    for k, (name, tag) in enumerate(phsf.PARTICLES):
+        sel = kinds == k
+        print("{0}: {1} sampled, mean energy {2}".format(name, int(sel.sum()), float(records["e"][sel].mean()) if sel.any() else 0.0))
+
+    sys.exit(0)
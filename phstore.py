@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import multiprocessing
+
+import numpy as np
+
+import phsf
+import query
+import archive
+import registry
+import process_run
+
+CHUNK = 65536 # records per column chunk
+
+STATS = phsf.FIELDS + ("r",) # fields having min/max in chunk statistics
+
+# Store layout, partitioned by particle, collimator and seeds:
+#
+#   root/photons/C25/1234_5678/<run>.000000.e.npy    one file per column of the chunk
+#   root/photons/C25/1234_5678/<run>.000000.json     chunk statistics, written last
+
+
+def partition_dir(root, particle, C, seed1, seed2):
+    """
+    Return directory of the partition
+    """
+    return os.path.join(root, particle, "C{0}".format(C), "{0}_{1}".format(seed1, seed2))
+
+
+def column_stats(columns):
+    """
+    Compute min/max of every column and of the radius in xy plane
+
+    Parameters
+    ----------
+
+    columns: dictionary
+        field to array, all of the same non-zero length
+
+    returns: dictionary
+        field to [min, max]
+    """
+
+    stats = {f: [float(v.min()), float(v.max())] for f, v in columns.items()}
+
+    r = query.field_values(columns, "r", slice(None))
+    stats["r"] = [float(r.min()), float(r.max())]
+
+    return stats
+
+
+def write_chunk(path, chunk_id, columns, meta):
+    """
+    Write column chunk and its statistics. Statistics are written last
+    and renamed into place, so readers never see a partial chunk.
+
+    Parameters
+    ----------
+
+    path: string
+        partition directory
+
+    chunk_id: string
+        chunk name, unique in the partition
+
+    columns: dictionary
+        field to array
+
+    meta: dictionary
+        extra information stored with statistics
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    for f, v in columns.items():
+        np.save(os.path.join(path, "{0}.{1}.npy".format(chunk_id, f)), np.ascontiguousarray(v))
+
+    info = dict(meta)
+    info.update({"count": len(next(iter(columns.values()))), "fields": list(columns), "stats": column_stats(columns)})
+
+    fname = os.path.join(path, chunk_id + ".json")
+    with open(fname + ".tmp", "w") as f:
+        json.dump(info, f)
+    os.replace(fname + ".tmp", fname)
+
+
+def append(root, run_name, arrays, chunk = CHUNK):
+    """
+    Append particles of the run to the store
+
+    Parameters
+    ----------
+
+    root: string
+        store directory
+
+    run_name: string
+        run archive or output name, C and seeds are parsed from it
+
+    arrays: dictionary
+        particle name to array of records
+
+    chunk: integer
+        records per column chunk
+
+    returns: integer
+        number of chunks written
+    """
+
+    key = registry.parse_archive(run_name)
+    if key is None:
+        raise ValueError("Not a run name {0}".format(run_name))
+
+    C, nof_tracks, nof_threads, seed1, seed2 = key
+    stem = archive.strip_suffix(run_name) or run_name
+    meta = {"run": run_name, "C": C, "nof_tracks": nof_tracks, "seeds": [seed1, seed2]}
+
+    nof_chunks = 0
+    for name, tag in phsf.PARTICLES:
+        a = arrays.get(name)
+        if a is None or len(a) == 0:
+            continue
+
+        path = partition_dir(root, name, C, seed1, seed2)
+        for k, start in enumerate(range(0, len(a), chunk)):
+            block = a[start:start + chunk]
+            columns = {f: block[f] for f in block.dtype.names}
+            write_chunk(path, "{0}.{1:06d}".format(stem, k), columns, meta)
+            nof_chunks += 1
+
+    return nof_chunks
+
+
+def append_one(args):
+    """
+    Read single run archive and append it to the store, to be used as a pool worker
+
+    Parameters
+    ----------
+
+    args: tuple
+        store directory, archives directory, run name, chunk size and precision
+
+    returns: tuple
+        run name and number of chunks written, None if the run failed
+    """
+
+    root, dir_name, run_name, chunk, precision = args
+
+    g, e, p, signs = process_run.read_run(dir_name, run_name)
+    if signs is None:
+        return run_name, None # failed, a readable run might have no photons at all
+
+    dtype  = phsf.make_dtype(precision)
+    arrays = {name: phsf.lines2array(lines, tag, dtype) for (name, tag), lines in zip(phsf.PARTICLES, (g, e, p))}
+
+    return run_name, append(root, run_name, arrays, chunk)
+
+
+def append_dir(root, dir_name, nof_workers = 1, chunk = CHUNK, precision = "double"):
+    """
+    Append all run archives in the directory to the store, runs are
+    written in parallel, each into its own chunks
+
+    returns: list of tuples
+        run name and number of chunks written, None if the run failed
+    """
+
+    names = sorted(q for q in os.listdir(dir_name) if archive.codec_of(q) is not None)
+    tasks = [(root, dir_name, name, chunk, precision) for name in names]
+
+    if nof_workers <= 1:
+        return [append_one(t) for t in tasks]
+
+    with multiprocessing.Pool(nof_workers) as pool:
+        return list(pool.imap_unordered(append_one, tasks))
+
+
+def case_seeds(cases, chunking = None):
+    """
+    Return seeds of the runs the cases are computed in, to filter by, as
+    cases split into chunks by main.main are stored under derived seeds
+
+    Parameters
+    ----------
+
+    cases: list of strings
+        cases as in cases.txt
+
+    chunking: dictionary
+        run configuration to its tracks per chunk, read from the
+        configuration file of the case if not there
+
+    returns: list of tuples
+        seed pairs
+    """
+
+    chunking = dict(chunking or {})
+
+    return [seed for case in cases if case for tracks, seed in registry.case_runs(case, chunking)]
+
+
+def list_chunks(root, particles = None, C = None, seeds = None):
+    """
+    List committed chunks, pruning partitions which do not match
+
+    Parameters
+    ----------
+
+    root: string
+        store directory
+
+    particles: list of strings
+        particle names, all if None
+
+    C: list of integers
+        collimators, all if None
+
+    seeds: list of tuples
+        seed pairs of runs, all if None, see case_seeds for chunked cases
+
+    returns: generator of tuples
+        particle name, partition directory, chunk id and chunk statistics
+    """
+
+    for name, tag in phsf.PARTICLES:
+        if particles is not None and name not in particles:
+            continue
+
+        pdir = os.path.join(root, name)
+        if not os.path.isdir(pdir):
+            continue
+
+        for cdir in sorted(os.listdir(pdir)):
+            if C is not None and cdir not in ["C{0}".format(c) for c in C]:
+                continue
+
+            for sdir in sorted(os.listdir(os.path.join(pdir, cdir))):
+                if seeds is not None and sdir not in ["{0}_{1}".format(s1, s2) for s1, s2 in seeds]:
+                    continue
+
+                path = os.path.join(pdir, cdir, sdir)
+                for fname in sorted(os.listdir(path)):
+                    if fname.endswith(".json"):
+                        with open(os.path.join(path, fname)) as f:
+                            yield name, path, fname[:-len(".json")], json.load(f)
+
+
+def may_match(stats, where):
+    """
+    Given chunk statistics, check if any record of the chunk might pass the filter
+    """
+
+    for field, (lo, hi) in where.items():
+        if field not in stats:
+            continue
+
+        vmin, vmax = stats[field]
+        if lo is not None and vmax <= lo:
+            return False
+        if hi is not None and vmin >= hi:
+            return False
+
+    return True
+
+
+class Columns(dict):
+    """
+    Columns of the chunk, memory-mapped on first access, so only
+    fields which are asked for are ever read
+    """
+
+    def __init__(self, path, chunk_id):
+        super().__init__()
+        self.path = path
+        self.chunk_id = chunk_id
+
+    def __missing__(self, field):
+        v = np.load(os.path.join(self.path, "{0}.{1}.npy".format(self.chunk_id, field)), mmap_mode="r")
+        self[field] = v
+        return v
+
+
+def scan(root, particles = None, where = None, C = None, seeds = None, fields = phsf.FIELDS, counters = None):
+    """
+    Iterate over records passing the filter, skipping partitions and
+    chunks which cannot match it
+
+    Parameters
+    ----------
+
+    root: string
+        store directory
+
+    particles: list of strings
+        particle names, all if None
+
+    where: dictionary
+        field to (low, high) range, fields are phsf.FIELDS and "r"
+
+    C: list of integers
+        collimators, all if None
+
+    seeds: list of tuples
+        seed pairs of runs, all if None, see case_seeds for chunked cases
+
+    fields: tuple of strings
+        fields to return
+
+    counters: dictionary
+        if not None, number of chunks "read" and "skipped" are added to it
+
+    returns: generator of tuples
+        particle name and dictionary of field to array of selected records
+    """
+
+    if where is None:
+        where = dict()
+
+    for name, path, chunk_id, info in list_chunks(root, particles, C, seeds):
+        if not may_match(info["stats"], where):
+            if counters is not None:
+                counters["skipped"] = counters.get("skipped", 0) + 1
+            continue
+
+        if counters is not None:
+            counters["read"] = counters.get("read", 0) + 1
+
+        columns = Columns(path, chunk_id)
+        idx = query.select(columns, where, info["count"])
+        if len(idx) > 0:
+            yield name, {f: np.asarray(columns[f][idx]) for f in fields}
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args > 3 and sys.argv[1] == "add":
+        nof_workers = int(sys.argv[4]) if nof_args > 4 else 1
+        for run_name, nof_chunks in append_dir(sys.argv[2], sys.argv[3], nof_workers):
+            print("{0}: {1} chunks".format(run_name, nof_chunks))
+        sys.exit(0)
+
+    if nof_args > 2 and sys.argv[1] == "query":
+        particles = None
+        if nof_args > 3 and sys.argv[3] != "all":
+            particles = [sys.argv[3]]
+
+        conds = sys.argv[4:]
+        C = [int(q[1:]) for q in conds if q[:1] == "C" and q[1:].isdigit()] or None
+        where = query.make_where([q for q in conds if not (q[:1] == "C" and q[1:].isdigit())])
+
+        counters = dict()
+        totals = dict()
+        for name, columns in scan(sys.argv[2], particles, where, C, fields=("e",), counters=counters):
+            n, esum = totals.get(name, (0, 0.0))
+            totals[name] = (n + len(columns["e"]), esum + float(columns["e"].sum(dtype=np.float64)))
+
+        for name, (n, esum) in totals.items():
+            print("{0}: {1} records, energy sum {2}".format(name, n, esum))
+        print("chunks read {0}, skipped {1}".format(counters.get("read", 0), counters.get("skipped", 0)))
+        sys.exit(0)
+
+    print("Use: phstore add <store dir> <dir with run archives> [workers]")
+    print("     phstore query <store dir> [photons|electrons|positrons|all] [C25 ...] [conditions like e>0.5 r<10 ...]")
+    sys.exit(1)
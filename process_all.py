@@ -3,12 +3,17 @@
 import os
 import sys
 import shutil
-import fnmatch
+import json
+import multiprocessing
 
+import archive
 import process_run
 
 PATTERN = "*.tar.xz"
 
+# binary header entry telling its runs are only the archives which were read
+RUNS_READ = {"runs-read": True}
+
 
 def get_lsof(dir_name, pattern):
     """
@@ -21,16 +26,56 @@ def get_lsof(dir_name, pattern):
         return None
 
     for output_name in os.listdir(dir_name):
-        if fnmatch.fnmatch(output_name, "*.xz"):
+        if archive.codec_of(output_name) is not None:
             fname = (dir_name, output_name)
             lsof.append(fname)
 
+    lsof.sort() # deterministic order of runs regardless of directory listing
+
     return lsof
 
 
-def process_all(dir_name, pattern):
+def process_one(fname):
+    """
+    Process single run, to be used as a pool worker
+
+    Parameters
+    ----------
+
+    fname: tuple
+        directory name and run name
+
+    returns: tuple
+        photons, electrons and positrons of the run, and whether it was read
+    """
+
+    dir_name, run_name = fname
+
+    g, e, p, signs = process_run.read_run(dir_name, run_name)
+
+    return g, e, p, signs is not None
+
+
+def process_all(dir_name, pattern, nof_workers = 1):
     """
     Given directory name and pattern, process all files in the directory which follows the pattern
+
+    Parameters
+    ----------
+
+    dir_name: string
+        name of the directory of the cases
+
+    pattern: string
+        pattern of the run archives
+
+    nof_workers: integer
+        number of worker processes, each handling whole archives;
+        results are merged in the sorted order of archives
+
+    returns: tuple
+        photons, electrons and positrons, None if there are none, and names of
+        the archives read, failed ones left out
     """
 
     lsof = get_lsof(dir_name, pattern)
@@ -41,8 +86,17 @@ def process_all(dir_name, pattern):
     electrons = list()
     positrons = list()
 
-    for dir_name, run_name in lsof:
-        gg, ee, pp = process_run.process_run(dir_name, run_name)
+    pool = None
+    if nof_workers > 1:
+        pool = multiprocessing.Pool(nof_workers)
+        results = pool.imap(process_one, lsof) # ordered, so merge is deterministic
+    else:
+        results = map(process_one, lsof)
+
+    runs = list()
+    for (d, run_name), (gg, ee, pp, ok) in zip(lsof, results):
+        if ok:
+            runs.append(run_name)
 
         if gg is not None:
             for g in gg:
@@ -56,38 +110,311 @@ def process_all(dir_name, pattern):
             for p in pp:
                 positrons.append(p)
 
-    return (photons if len(photons)>0 else None, electrons if len(electrons)>0 else None, positrons if len(positrons)>0 else None)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return (photons if len(photons)>0 else None, electrons if len(electrons)>0 else None, positrons if len(positrons)>0 else None, runs)
+
+
+def write_text(fname, gg, ee, pp):
+    """
+    Write particles as raw text lines from the Geant4 output
+    """
+
+    with open(fname, mode="w+") as f:
+        if gg is not None:
+            for g in gg:
+                f.write(g)
+
+        if ee is not None:
+            for e in ee:
+                f.write(e)
+
+        if pp is not None:
+            for p in pp:
+                f.write(p)
+
+
+def read_manifest(fname):
+    """
+    Read manifest of processed archives, or make an empty one
+
+    Parameters
+    ----------
+
+    fname: string
+        manifest file name
+
+    returns: dictionary
+        size of the committed output in bytes and processed runs,
+        keyed by archive name, with their signatures and particle counts
+    """
+
+    if not os.path.exists(fname):
+        return {"size": 0, "runs": dict()}
+
+    with open(fname, "rt") as f:
+        return json.load(f)
+
+
+def save_manifest(fname, manifest):
+    """
+    Atomically save manifest of processed archives
+
+    Parameters
+    ----------
+
+    fname: string
+        manifest file name
+
+    manifest: dictionary
+        manifest to save
+    """
+
+    tmp = fname + ".tmp"
+    with open(tmp, "wt") as f:
+        json.dump(manifest, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp, fname)
+
+
+def read_one(fname):
+    """
+    Read single run with its signatures, to be used as a pool worker
+
+    Parameters
+    ----------
+
+    fname: tuple
+        directory name and run name
+
+    returns: tuple
+        run name, photons, electrons, positrons and signatures of the run
+    """
+
+    dir_name, run_name = fname
+
+    g, e, p, signs = process_run.read_run(dir_name, run_name)
+
+    return run_name, g, e, p, signs
+
+
+def process_incremental(dir_name, pattern, out_name, nof_workers = 1, fmt = "text", precision = "double"):
+    """
+    Process only archives not yet in the manifest and append their particles to existing output
+
+    Archives are skipped if their name is in the manifest, or if their output signature
+    matches one already processed. The manifest is committed after each archive, so an
+    interrupted run resumes from the last committed archive. Text output is committed
+    together with its size, partially appended lines are dropped on resume. Binary output
+    is staged per archive in a PHSF file under out_name.parts and merged into the output
+    at the end, staged archives of an interrupted run are merged by the next one.
+
+    Parameters
+    ----------
+
+    dir_name: string
+        name of the directory of the cases
+
+    pattern: string
+        pattern of the run archives
+
+    out_name: string
+        output file name, manifest is kept next to it
+
+    nof_workers: integer
+        number of worker processes
+
+    fmt: string
+        "text" or "binary"
+
+    precision: string
+        precision of the binary output
+
+    returns: integer
+        number of newly processed archives, None if no directory
+    """
+
+    lsof = get_lsof(dir_name, pattern)
+    if lsof is None:
+        return None
+
+    man_name = out_name + ".manifest"
+    manifest = read_manifest(man_name)
+    runs     = manifest["runs"]
+
+    if fmt != "text":
+        import numpy as np
+        import phsf
+
+        parts_dir = out_name + ".parts"
+        header = phsf.read_header(out_name) if os.path.exists(out_name) else None
+
+        if header is not None and not os.path.exists(man_name):
+            # binary output made without manifest, e.g. by process_all: its header tells
+            # which runs were read, signatures are unknown, so renamed duplicates of them are not caught
+            if not header.get("runs-read"):
+                print("No manifest for {0} and it might list runs which failed, remove it to start over".format(out_name))
+                return None
+
+            for run_name in header["runs"]:
+                runs[run_name] = {"signatures": dict(), "counts": None}
+            print("Manifest made from {0}: {1} runs".format(out_name, len(runs)))
+
+        for run_name, info in list(runs.items()):
+            if "part" not in info:
+                continue
+            if header is not None and run_name in header["runs"]:
+                del info["part"] # merged, interrupted before the manifest was saved
+            elif not os.path.exists(info["part"]):
+                del runs[run_name] # to be processed again
+
+    known = dict() # output signature to run name
+    for run_name, info in runs.items():
+        sig = info["signatures"].get(process_run.output_name(run_name))
+        if sig is not None and "duplicate" not in info:
+            known[sig] = run_name
+
+    lsof = [fname for fname in lsof if fname[1] not in runs]
+    print("New archives to process: {0}".format(len(lsof)))
+
+    pool = None
+    if nof_workers > 1:
+        pool = multiprocessing.Pool(nof_workers)
+        results = pool.imap(read_one, lsof)
+    else:
+        results = map(read_one, lsof)
+
+    f = None
+    if fmt == "text":
+        f = open(out_name, "r+b" if os.path.exists(out_name) else "w+b")
+        f.truncate(manifest["size"]) # drop lines of the interrupted archive
+        f.seek(manifest["size"])
+
+    nof_new = 0
+    try:
+        for run_name, g, e, p, signs in results:
+            if signs is None:
+                continue # failed, to be retried next time
+
+            sig = signs.get(process_run.output_name(run_name))
+            if sig is not None and sig in known:
+                print("Duplicate of {0}: {1}".format(known[sig], run_name))
+                runs[run_name] = {"signatures": signs, "counts": [0, 0, 0], "duplicate": known[sig]}
+            else:
+                particles = (g, e, p)
+                if f is not None:
+                    for lines in particles:
+                        if lines is not None:
+                            f.write("".join(lines).encode("utf-8"))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    manifest["size"] = f.tell()
+                else:
+                    os.makedirs(parts_dir, exist_ok=True)
+                    part = os.path.join(parts_dir, run_name + ".bin")
+                    phsf.write_phsf(part + ".tmp", g, e, p, [run_name], precision)
+                    os.replace(part + ".tmp", part)
+
+                runs[run_name] = {"signatures": signs, "counts": [len(q) if q is not None else 0 for q in particles]}
+                if f is None:
+                    runs[run_name]["part"] = part
+                if sig is not None:
+                    known[sig] = run_name
+                nof_new += 1
+
+            save_manifest(man_name, manifest)
+    finally:
+        if f is not None:
+            f.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if f is None:
+        dtype = phsf.make_dtype(precision)
+
+        blocks = [[] for name, tag in phsf.PARTICLES]
+        if header is not None:
+            header, old = phsf.read_phsf(out_name)
+            for b, (name, tag) in zip(blocks, phsf.PARTICLES):
+                b.append(old[name].astype(dtype))
+
+        parts = [info["part"] for run_name, info in runs.items() if "part" in info]
+        for part in parts:
+            h, staged = phsf.read_phsf(part)
+            for b, (name, tag) in zip(blocks, phsf.PARTICLES):
+                b.append(staged[name].astype(dtype))
+
+        new = [np.concatenate(b) if b else np.empty(0, dtype=dtype) for b in blocks]
+
+        names = [run_name for run_name, info in sorted(runs.items()) if "duplicate" not in info]
+        phsf.write_phsf(out_name + ".tmp", *new, runs = names, precision = precision, meta = RUNS_READ)
+        os.replace(out_name + ".tmp", out_name)
+
+        for info in runs.values():
+            info.pop("part", None)
+        save_manifest(man_name, manifest)
+
+        for part in parts:
+            os.remove(part)
+        if os.path.isdir(parts_dir) and not os.listdir(parts_dir):
+            os.rmdir(parts_dir)
+
+    return nof_new
 
 
 if __name__ =='__main__':
     nof_args = len(sys.argv)
 
     if nof_args == 1:
-        print("need dir_name")
+        print("need dir_name [text|binary] [double|single|half] [# of workers] [any value for incremental]")
         sys.exit(1)
 
     dir_name = None
     if nof_args >= 2:
         dir_name = sys.argv[1]
 
-    gg, ee, pp = process_all(dir_name, PATTERN)
+    fmt = "text"
+    if nof_args >= 3:
+        fmt = sys.argv[2]
+
+    precision = "double"
+    if nof_args >= 4:
+        precision = sys.argv[3]
+
+    nof_workers = 1
+    if nof_args >= 5:
+        nof_workers = int(sys.argv[4])
+
+    incremental = nof_args >= 6
+
+    if fmt not in ("text", "binary"):
+        print("Unknown format {0}".format(fmt))
+        sys.exit(1)
+
+    out_name = "PHSF.bin" if fmt == "binary" else "PHSF"
+
+    if incremental:
+        nof_new = process_incremental(dir_name, PATTERN, out_name, nof_workers, fmt, precision)
+        print("Processed new archives: {0}".format(nof_new))
+        sys.exit(0 if nof_new is not None else 1)
+
+    gg, ee, pp, runs = process_all(dir_name, PATTERN, nof_workers)
 
     print(len(gg)) if gg is not None else print("=== No photons ===")
     print(len(ee)) if ee is not None else print("=== No electrons ===")
     print(len(pp)) if pp is not None else print("=== No positrons ===")
 
-    with open("PHSF", mode="w+") as f:
-        if gg is not None:
-            for g in gg:
-                f.write(g)
+    if fmt == "binary":
+        import phsf
 
-        if ee is not None:
-            for e in ee:
-                f.write(e)
-
-        if pp is not None:
-            for p in pp:
-                f.write(p)
+        phsf.write_phsf(out_name, gg, ee, pp, runs, precision, RUNS_READ)
+    else:
+        write_text(out_name, gg, ee, pp)
 
     rc = 0
     sys.exit(rc)
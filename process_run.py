@@ -2,39 +2,36 @@
 
 import os
 import sys
-import subprocess
+import hashlib
+import tarfile
 
+import archive
 
-def unpack_run(dir_name, run_name):
+def output_name(run_name):
     """
-    Given the run directory and filename, unpack it
-
-    Parameters
-    ----------
-
-    dir_name: string
-        name of the directory of the cases
+    Given the archive name, return name of the output file inside
+    """
+    return archive.strip_suffix(os.path.basename(run_name)) # remove tar.xz
 
-    run_name: string
-        name of the archive with compressed run data
 
-    returns: (integer, output
-        0 is Ok, non-zero means error
+def filter_particles(lines):
+    """
+    Given iterable over output lines, filter out photons, electrons and positrons
     """
 
-    full_name = os.path.join(dir_name, run_name)
-    full_name = full_name.replace("(", "\\(")
-    full_name = full_name.replace(")", "\\)")
-    cmd = "tar xJvf {0}".format(full_name)
-    print(cmd)
-
-    rc = subprocess.call(cmd, shell=True)
+    photons   = list()
+    electrons = list()
+    positrons = list()
 
-    output = None
-    if rc == 0:
-        output = os.path.splitext(os.path.splitext(run_name)[0])[0] # remote tar.xz
+    for line in lines:
+        if "GGG" in line:
+            photons.append(line)
+        elif "EEE" in line:
+            electrons.append(line)
+        elif "PPP" in line:
+            positrons.append(line)
 
-    return (rc, output)
+    return (photons if len(photons)>0 else None, electrons if len(electrons)>0 else None, positrons if len(positrons)>0 else None)
 
 
 def process_output(output):
@@ -45,35 +42,95 @@ def process_output(output):
     if output is None:
         return (None, None, None) # no photons, electrons or positrons
 
-    photons   = list()
-    electrons = list()
-    positrons = list()
-
     with open(output, "r") as f:
-        for cnt, line in enumerate(f):
-            if "GGG" in line:
-                photons.append(line)
-            elif "EEE" in line:
-                electrons.append(line)
-            elif "PPP" in line:
-                positrons.append(line)
+        return filter_particles(f)
 
-    return (photons if len(photons)>0 else None, electrons if len(electrons)>0 else None, positrons if len(positrons)>0 else None)
+
+def read_signatures(lines):
+    """
+    Parse signatures file made by main.sign
+
+    Parameters
+    ----------
+
+    lines: iterable over strings
+        lines in the "file name: hash" format
+
+    returns: dictionary
+        file name to hash
+    """
+
+    signs = dict()
+    for line in lines:
+        name, sep, value = line.rpartition(":")
+        if sep:
+            signs[name.strip()] = value.strip()
+
+    return signs
 
 
-def remove_leftovers(output):
+def hashed_lines(f, hasher):
     """
-    Remove the output files
+    Iterate over decoded lines of binary stream, hashing its raw content
     """
-    os.remove(output)
-    os.remove("batch.mac")
-    os.remove("col.rlog")
-    os.remove("sha1")
 
+    for line in f:
+        hasher.update(line)
+        yield line.decode("utf-8", "replace")
 
-def process_run(dir_name, run_name):
+
+def process_archive(full_name):
     """
-    Given the run directory and filename, process run
+    Given the archive, stream its output member through the particle filter,
+    decompressing in memory without extracting anything to disk. Output is
+    hashed while read and checked against the signatures shipped with the run,
+    archive.SignatureError is raised on mismatch.
+
+    Parameters
+    ----------
+
+    full_name: string
+        path to the archive with compressed run data
+
+    returns: tuple
+        photons, electrons and positrons, None if not found, and signatures shipped with the run
+    """
+
+    output = output_name(full_name)
+
+    g, e, p = None, None, None
+    signs  = dict()
+    hasher = None
+    with archive.open_reader(full_name) as f, tarfile.open(fileobj=f, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            name = os.path.basename(member.name)
+            if name == output:
+                # archives made by tar carry no pax header, they were signed by main.sign with sha1
+                hname = member.pax_headers.get(archive.HASH_KEY, "sha1")
+                if hname not in archive.SIGN_ALGOS:
+                    raise archive.SignatureError("{0} is signed with unknown {1}".format(output, hname))
+                hasher = hashlib.new(hname)
+                with tar.extractfile(member) as f:
+                    g, e, p = filter_particles(hashed_lines(f, hasher))
+            elif name in archive.SIGN_ALGOS:
+                with tar.extractfile(member) as f:
+                    signs = read_signatures(line.decode("utf-8", "replace") for line in f)
+                    algo  = name
+
+    sig = signs.get(output)
+    if hasher is not None and sig is not None:
+        if algo != hasher.name or sig != hasher.hexdigest():
+            raise archive.SignatureError("{0} does not match its signature".format(output))
+
+    return g, e, p, signs
+
+
+def read_run(dir_name, run_name):
+    """
+    Given the run directory and filename, read particles and signatures of the run
 
     Parameters
     ----------
@@ -83,19 +140,40 @@ def process_run(dir_name, run_name):
 
     run_name: string
         name of the archive with compressed run data
+
+    returns: tuple
+        photons, electrons, positrons and signatures, Nones on failure
     """
 
     if run_name is None:
-        return None, None, None
+        return None, None, None, None
+
+    full_name = os.path.join(dir_name, run_name)
+    print(full_name)
+
+    try:
+        return process_archive(full_name)
+    except archive.ERRORS as e:
+        print("Cannot process {0}: {1}".format(full_name, e))
 
-    rc, output = unpack_run(dir_name, run_name)
+    return None, None, None, None
+
+
+def process_run(dir_name, run_name):
+    """
+    Given the run directory and filename, process run
+
+    Parameters
+    ----------
+
+    dir_name: string
+        name of the directory of the cases
+
+    run_name: string
+        name of the archive with compressed run data
+    """
 
-    g = None
-    e = None
-    p = None
-    if rc == 0:
-        g, e, p = process_output(output)
-        remove_leftovers(output)
+    g, e, p, signs = read_run(dir_name, run_name)
 
     return g, e, p
 
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import re
+import sys
+
+import numpy as np
+
+import phsf
+
+CHUNK = 1 << 20 # records examined at once
+
+COND_RE = re.compile(r"^(\w+)\s*(<|>)\s*([-+0-9.eE]+)$")
+
+
+def make_where(conditions):
+    """
+    Parse conditions like "e>0.5" or "r<10" into ranges
+
+    Parameters
+    ----------
+
+    conditions: list of strings
+        field, < or > and value
+
+    returns: dictionary
+        field to (low, high) range, None for open end
+    """
+
+    where = dict()
+    for cond in conditions:
+        m = COND_RE.match(cond)
+        if m is None:
+            raise ValueError("Bad condition {0}".format(cond))
+
+        field, op, value = m.group(1), m.group(2), float(m.group(3))
+        lo, hi = where.get(field, (None, None))
+        if op == ">":
+            lo = value
+        else:
+            hi = value
+        where[field] = (lo, hi)
+
+    return where
+
+
+def field_values(block, field, idx):
+    """
+    Return field values of the records idx of the block, "r" being radius in xy plane
+    """
+
+    if field == "r":
+        x = block["x"][idx].astype(np.float64)
+        y = block["y"][idx].astype(np.float64)
+        return np.sqrt(x*x + y*y)
+
+    return block[field][idx]
+
+
+def select(block, where, n = None):
+    """
+    Evaluate range predicates one field after another, each one
+    only over records which passed the previous ones
+
+    Parameters
+    ----------
+
+    block: numpy array or mapping
+        records, possibly memory-mapped, or field to column
+
+    where: dictionary
+        field to (low, high) range
+
+    n: integer
+        number of records, len(block) if None
+
+    returns: numpy array
+        indices of records passing all predicates
+    """
+
+    idx = np.arange(len(block) if n is None else n)
+    for field, (lo, hi) in where.items():
+        if len(idx) == 0:
+            break
+
+        v = field_values(block, field, idx)
+        keep = np.ones(len(idx), dtype=bool)
+        if lo is not None:
+            keep &= v > lo
+        if hi is not None:
+            keep &= v < hi
+        idx = idx[keep]
+
+    return idx
+
+
+def scan(fname, particles = None, where = None, chunk = CHUNK):
+    """
+    Iterate over records passing the filter, reading memory-mapped file
+    chunk by chunk. Blocks of particles not asked for are never touched.
+
+    Parameters
+    ----------
+
+    fname: string
+        binary phase-space file
+
+    particles: list of strings
+        particle names, all if None
+
+    where: dictionary
+        field to (low, high) range, fields are phsf.FIELDS and "r"
+
+    chunk: integer
+        records examined at once
+
+    returns: generator of tuples
+        particle name and array of records passing the filter
+    """
+
+    header, arrays = phsf.read_phsf(fname, mmap = True)
+
+    if where is None:
+        where = dict()
+
+    for name, tag in phsf.PARTICLES:
+        if particles is not None and name not in particles:
+            continue
+
+        a = arrays[name]
+        for start in range(0, len(a), chunk):
+            block = a[start:start + chunk]
+            idx = select(block, where)
+            if len(idx) > 0:
+                yield name, np.asarray(block[idx])
+
+
+def aggregate(fname, particles = None, where = None, hist = None, chunk = CHUNK):
+    """
+    Count, sum and histogram records passing the filter
+
+    Parameters
+    ----------
+
+    fname: string
+        binary phase-space file
+
+    particles: list of strings
+        particle names, all if None
+
+    where: dictionary
+        field to (low, high) range
+
+    hist: dictionary
+        field to bin edges, fields to histogram
+
+    returns: dictionary
+        per particle count, sum of every field and histograms
+    """
+
+    if hist is None:
+        hist = dict()
+
+    result = dict()
+    for name, tag in phsf.PARTICLES:
+        if particles is None or name in particles:
+            result[name] = { "count": 0,
+                             "sum":   {f: 0.0 for f in phsf.FIELDS},
+                             "hist":  {f: np.zeros(len(edges) - 1, dtype=np.float64) for f, edges in hist.items()} }
+
+    for name, records in scan(fname, particles, where, chunk):
+        r = result[name]
+        r["count"] += len(records)
+        for f in records.dtype.names:
+            if f in r["sum"]:
+                r["sum"][f] += float(records[f].sum(dtype=np.float64))
+        for f, edges in hist.items():
+            r["hist"][f] += np.histogram(field_values(records, f, slice(None)), bins=edges)[0]
+
+    return result
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args < 2:
+        print("Use: query PHSF.bin [photons|electrons|positrons|all] [conditions like e>0.5 r<10 ...]")
+        sys.exit(1)
+
+    fname = sys.argv[1]
+
+    particles = None
+    if nof_args > 2 and sys.argv[2] != "all":
+        particles = [sys.argv[2]]
+
+    where = make_where(sys.argv[3:])
+
+    for name, r in aggregate(fname, particles, where).items():
+        print("{0}: {1} records, energy sum {2}".format(name, r["count"], r["sum"]["e"]))
+
+    sys.exit(0)
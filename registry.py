@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+
+import archive
+import helpers
+
+# archive name as made by main.run and main.pipeline, anchored at the archive
+# suffix so leftovers like parts of an interrupted composed upload do not match
+ARCHIVE_RE = re.compile(r"_C(\d+)_(\d+)_(\d+)_\((\d+),(\d+)\)\.output(?:" + "|".join(re.escape(q) for q in archive.SUFFIXES.values()) + r")?$")
+
+REGISTRY = "registry.db" # default registry file
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    name        TEXT PRIMARY KEY,
+    config      TEXT,
+    C           INTEGER,
+    nof_tracks  INTEGER,
+    nof_threads INTEGER,
+    seed1       INTEGER,
+    seed2       INTEGER,
+    submitted   REAL
+);
+CREATE INDEX IF NOT EXISTS cases_key ON cases (C, nof_tracks, nof_threads, seed1, seed2);
+
+CREATE TABLE IF NOT EXISTS chunks (
+    name        TEXT,
+    C           INTEGER,
+    nof_tracks  INTEGER,
+    seed1       INTEGER,
+    seed2       INTEGER,
+    PRIMARY KEY (name, seed1, seed2)
+);
+CREATE INDEX IF NOT EXISTS chunks_key ON chunks (C, nof_tracks, seed1, seed2);
+
+CREATE TABLE IF NOT EXISTS results (
+    archive     TEXT PRIMARY KEY,
+    C           INTEGER,
+    nof_tracks  INTEGER,
+    nof_threads INTEGER,
+    seed1       INTEGER,
+    seed2       INTEGER,
+    signature   TEXT,
+    completed   REAL
+);
+CREATE INDEX IF NOT EXISTS results_key ON results (C, nof_tracks, nof_threads, seed1, seed2);
+CREATE INDEX IF NOT EXISTS results_signature ON results (signature);
+"""
+
+
+def open_registry(fname):
+    """
+    Open run registry, creating tables if needed
+
+    Parameters
+    ----------
+
+    fname: string
+        SQLite database file name, ":memory:" for in-memory one
+
+    returns: sqlite3.Connection
+        connection to the registry
+    """
+
+    conn = sqlite3.connect(fname)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def parse_case(case):
+    """
+    Parse case line from the cases list
+
+    Parameters
+    ----------
+
+    case: string
+        case as in cases.txt, "run C nof_tracks nof_threads seed1 seed2"
+
+    returns: tuple
+        case name, run config and key values
+    """
+
+    s = helpers.case2args(case)
+    return (helpers.case2name(case), s[0], int(s[1]), int(s[2]), int(s[3]), int(s[4]), int(s[5]))
+
+
+def parse_archive(name):
+    """
+    Parse archive name into key values
+
+    Parameters
+    ----------
+
+    name: string
+        archive name
+
+    returns: tuple
+        key values, None if name is not of a run archive
+    """
+
+    m = ARCHIVE_RE.search(name)
+    if m is None:
+        return None
+
+    return tuple(int(q) for q in m.groups())
+
+
+def tracks_per_chunk(config):
+    """
+    Return "tracks-per-chunk" of the run configuration, 0 if the
+    configuration is not here or does not split runs
+    """
+
+    try:
+        with open(config, "rt") as f:
+            return int(json.load(f).get("tracks-per-chunk", 0))
+    except (OSError, ValueError):
+        return 0
+
+
+def case_runs(case, chunking):
+    """
+    Return runs the case is computed in, the case itself or its chunks
+
+    Parameters
+    ----------
+
+    case: string
+        case as in cases.txt
+
+    chunking: dictionary
+        run configuration to its tracks per chunk, filled from the
+        configuration file of the case if not there
+
+    returns: list of tuples
+        number of tracks and seeds of every run
+    """
+
+    name, config, C, nof_tracks, nof_threads, seed1, seed2 = parse_case(case)
+
+    if config not in chunking:
+        chunking[config] = tracks_per_chunk(config)
+
+    return helpers.make_chunks(nof_tracks, chunking[config], (seed1, seed2))
+
+
+def add_cases(conn, cases, submitted = None, chunking = None):
+    """
+    Record cases, optionally marking them as submitted, together with
+    the runs each case is computed in, see main.main and helpers.make_chunks
+
+    Parameters
+    ----------
+
+    conn: sqlite3.Connection
+        registry
+
+    cases: list of strings
+        cases as in cases.txt
+
+    submitted: float
+        submission time, seconds since epoch, None if not submitted yet
+
+    chunking: dictionary
+        run configuration to its tracks per chunk, read from the
+        configuration file of the case if not there
+    """
+
+    chunking = dict(chunking or {})
+
+    rows   = list()
+    chunks = list()
+    for case in cases:
+        if not case:
+            continue
+
+        name, config, C, nof_tracks, nof_threads, seed1, seed2 = parse_case(case)
+        rows.append((name, config, C, nof_tracks, nof_threads, seed1, seed2, submitted))
+
+        for tracks, seed in case_runs(case, chunking):
+            chunks.append((name, C, tracks, seed[0], seed[1]))
+
+    with conn:
+        conn.executemany("INSERT INTO cases VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                         "ON CONFLICT(name) DO UPDATE SET submitted = COALESCE(excluded.submitted, submitted)", rows)
+        conn.executemany("DELETE FROM chunks WHERE name = ?", [(row[0],) for row in rows])
+        conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?)", chunks)
+
+
+def record_submitted(fname, cases, submitted = None):
+    """
+    Record cases just submitted, e.g. as pods, in the registry file
+
+    Parameters
+    ----------
+
+    fname: string
+        SQLite database file name
+
+    cases: list of strings
+        cases as in cases.txt, with the number of threads they were submitted with
+
+    submitted: float
+        submission time, seconds since epoch, now if None
+    """
+
+    conn = open_registry(fname)
+    try:
+        add_cases(conn, cases, submitted if submitted is not None else time.time())
+    finally:
+        conn.close()
+
+
+def read_listing(source):
+    """
+    Read listing of results, either a directory or a text file
+    with one archive per line, e.g. gsutil ls output
+
+    Parameters
+    ----------
+
+    source: string
+        directory or listing file name
+
+    returns: list of tuples
+        archive base name and completion time, None if unknown
+    """
+
+    if os.path.isdir(source):
+        return [(name, os.path.getmtime(os.path.join(source, name))) for name in os.listdir(source)]
+
+    listing = list()
+    with open(source, "rt") as f:
+        for line in f:
+            s = line.split()
+            if s:
+                listing.append((os.path.basename(s[-1]), None))
+
+    return listing
+
+
+def add_results(conn, listing):
+    """
+    Record results from a listing in one pass
+
+    Parameters
+    ----------
+
+    conn: sqlite3.Connection
+        registry
+
+    listing: list of tuples
+        archive name and completion time
+
+    returns: integer
+        number of run archives recorded
+    """
+
+    now  = time.time()
+    rows = list()
+    for name, completed in listing:
+        key = parse_archive(name)
+        if key is not None:
+            rows.append((name,) + key + (completed if completed is not None else now,))
+
+    with conn:
+        conn.executemany("INSERT INTO results (archive, C, nof_tracks, nof_threads, seed1, seed2, completed) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                         "ON CONFLICT(archive) DO NOTHING", rows)
+
+    return len(rows)
+
+
+def add_signatures(conn, manifest):
+    """
+    Record output signatures from the process_all manifest
+
+    Parameters
+    ----------
+
+    conn: sqlite3.Connection
+        registry
+
+    manifest: dictionary
+        manifest as made by process_all.process_incremental
+    """
+
+    import process_run
+
+    rows = list()
+    for archive, info in manifest["runs"].items():
+        sig = info["signatures"].get(process_run.output_name(archive))
+        if sig is not None:
+            rows.append((sig, archive))
+
+    with conn:
+        conn.executemany("UPDATE results SET signature = ? WHERE archive = ?", rows)
+
+
+def missing(conn):
+    """
+    Return cases with any of their runs, the case itself or its chunks, without result.
+    Runs match results computed with any number of threads, as startCluster and
+    addCluster rewrite it to the planned one
+
+    returns: list of strings
+        case names
+    """
+
+    cur = conn.execute("SELECT c.name FROM cases c WHERE EXISTS "
+                       "(SELECT 1 FROM chunks k LEFT JOIN results r "
+                       "ON r.C = k.C AND r.nof_tracks = k.nof_tracks AND r.seed1 = k.seed1 AND r.seed2 = k.seed2 "
+                       "WHERE k.name = c.name AND r.archive IS NULL) ORDER BY c.rowid")
+    return [row[0] for row in cur]
+
+
+def duplicates(conn):
+    """
+    Return case parameters computed more than once
+
+    returns: list of tuples
+        key values and number of archives
+    """
+
+    cur = conn.execute("SELECT C, nof_tracks, nof_threads, seed1, seed2, COUNT(*) FROM results "
+                       "GROUP BY C, nof_tracks, nof_threads, seed1, seed2 HAVING COUNT(*) > 1")
+    return cur.fetchall()
+
+
+def duplicate_signatures(conn):
+    """
+    Return archives sharing the same output signature
+
+    returns: list of tuples
+        signature and archive name
+    """
+
+    cur = conn.execute("SELECT signature, archive FROM results WHERE signature IN "
+                       "(SELECT signature FROM results WHERE signature IS NOT NULL "
+                       "GROUP BY signature HAVING COUNT(*) > 1) ORDER BY signature, archive")
+    return cur.fetchall()
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args < 4:
+        print("Use: registry registry.db cases.txt <results dir or listing file>")
+        sys.exit(1)
+
+    conn = open_registry(sys.argv[1])
+
+    with open(sys.argv[2], "rt") as f:
+        add_cases(conn, [x.strip() for x in f.readlines()])
+
+    n = add_results(conn, read_listing(sys.argv[3]))
+    print("Results in listing: {0}".format(n))
+
+    for name in missing(conn):
+        print("Missing: {0}".format(name))
+
+    for dup in duplicates(conn):
+        print("Duplicate: {0}".format(dup))
+
+    for sig, archive in duplicate_signatures(conn):
+        print("Same signature {0}: {1}".format(sig, archive))
+
+    sys.exit(0)
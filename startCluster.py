@@ -5,9 +5,11 @@ import sys
 import json
 import shutil
 import subprocess
-import time
 
 import helpers
+import packing
+import registry
+import submit
 
 def make_cluster(CID, mach_type, nof_machs, ZID, disk_size, preempt = True):
     """
@@ -68,88 +70,6 @@ def auth_cluster(CID, ZID):
     return rc
 
 
-def read_template(template):
-    """
-    Read and return template file as JSON
-
-    Parameters
-    ------------
-
-    template: string
-        template name
-
-    returns: dictionary
-        JSON parsed as dictionary
-    """
-    data = None
-    with open(template) as data_file:
-        data = json.load(data_file)
-
-    return data
-
-
-def make_pod_from_template(temjson, case, docker2run):
-    """
-    Given JSON from template and case, make in-memory pod json
-
-    Parameters
-    ------------
-
-    temjson: dictionary
-        In-memory pod JSON
-
-    case: string
-        Case to compute name
-
-    docker2run: string
-        docker image to run
-
-    returns: dictionary
-        modified JSON suitable for computation
-    """
-
-    pod = helpers.case2pod( case )
-
-    temjson["metadata"]["name"] = pod
-
-    temjson["spec"]["containers"][0]["name"] = pod
-
-    temjson["spec"]["containers"][0]["image"] = docker2run
-
-    temjson["spec"]["containers"][0]["args"]  = helpers.case2args(case)
-
-    return temjson
-
-
-def make_json_pod(template, case, docker2run):
-    """
-    From template and case to calc, make appropriate pod JSON
-
-    Parameters
-    ------------
-
-    template: string
-        file name of the JSON template
-
-    case: string
-        Case to compute name
-
-    docker2run: string
-        docker image to run
-
-    returns: dictionary
-        modified JSON suitable for computation
-    """
-    temjson = read_template(template)
-    outjson = make_pod_from_template(temjson, case, docker2run)
-
-    fname = "pod" + "_" + helpers.case2name(case) + ".json"
-    with open(fname, "w+") as f:
-        f.write(json.dumps(outjson, indent=4))
-
-    return fname
-
-
 def read_config(cfname):
     """
     Read cluster configuration file as JSON
@@ -214,10 +134,24 @@ def main(cases_fname, nof_nodes, preempt = True):
 
     print("Reading Cases list from {0}".format(cases_fname))
 
-    cases = read_cases(cases_fname)
+    cases = [case for case in read_cases(cases_fname) if case]
 
     print("To compute Cases: {0}".format(len(cases)))
 
+    # threads per pod from config, or the largest one among the cases
+    nof_threads = cfg.get("threads-per-pod")
+    if nof_threads is None:
+        nof_threads = max((helpers.case2threads(case) for case in cases), default = 1)
+
+    try:
+        p = packing.plan(mtype, nof_nodes, len(cases), nof_threads)
+    except ValueError as e:
+        print("Cannot plan pods: {0}".format(e))
+        sys.exit(1)
+    packing.report(p)
+
+    cases = [helpers.set_case_threads(case, p["threads"]) for case in cases]
+
     print("Making cluster with nodes: {0}".format(nof_nodes))
 
     rc = make_cluster(CID, mtype, nof_nodes, ZID, disk_size=30, preempt = preempt)
@@ -232,18 +166,11 @@ def main(cases_fname, nof_nodes, preempt = True):
 
     docker2run = os.path.join(gcr, project, docker) # full path to docker
 
-    for case in cases:
-        pod_name = make_json_pod("colpod.json", case, docker2run)
-        cmd = "kubectl create -f " + pod_name
-        rc = 0
-        for k in range(0, 3): # several attempts to make a pod
-            rc = subprocess.call(cmd, shell=True)
-            if rc == 0:
-                time.sleep(0.5)
-                break
-
-        if rc != 0:
-            print("Cannot make case {0}".format(case))
+    failed = submit.submit_cases("colpod.json", cases, docker2run, p["mcpu-per-pod"])
+    for pod, err in sorted(failed.items()):
+        print("Cannot make case {0}: {1}".format(pod, err))
+
+    registry.record_submitted(cfg.get("registry", registry.REGISTRY), [case for case in cases if helpers.case2pod(case) not in failed])
 
     return 0
 
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import threading
+import collections
+import concurrent.futures
+
+UPLOAD_CHUNK = 32*1024*1024 # resumable upload chunk size, multiple of 256KiB
+PART_SIZE    = 64*1024*1024 # size of the part in parallel uploads
+NOF_PARTS    = 4            # parts uploaded at once
+COMPOSE_MAX  = 32           # max number of sources in one GCS compose call
+
+_clients = dict() # GCS clients by key file, reused between uploads
+_lock    = threading.Lock()
+
+
+def read_config(creds):
+    """
+    Read storage configuration. Old config_gs.json kept key file
+    in "user" and bucket in "pswd", those are still understood
+
+    Parameters
+    ------------
+
+    creds: string
+        JSON file with storage configuration
+
+    returns: dictionary
+        backend, and its parameters
+    """
+
+    with open(creds) as json_file:
+        data = json.load(json_file)
+
+    if "backend" not in data:
+        data = {"backend": "gcs", "key": data["user"], "bucket": data["pswd"], "dest": data["dest"]}
+
+    return data
+
+
+def open_storage(creds):
+    """
+    Make storage backend from configuration
+
+    Parameters
+    ------------
+
+    creds: string
+        JSON file with storage configuration
+
+    returns: LocalStorage or GCSStorage
+        storage backend, "parts" sets how many parts its streams upload at once
+    """
+
+    cfg = read_config(creds)
+
+    if cfg["backend"] == "local":
+        return LocalStorage(cfg["root"], cfg.get("dest", ""), cfg.get("parts", 1))
+
+    if cfg["backend"] == "gcs":
+        return GCSStorage(cfg["key"], cfg["bucket"], cfg.get("dest", ""), cfg.get("parts", 1))
+
+    raise ValueError("Unknown storage backend {0}".format(cfg["backend"]))
+
+
+def split_parts(size, part_size):
+    """
+    Split size into (offset, length) parts
+    """
+    return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)] or [(0, 0)]
+
+
+class LocalStorage:
+    """
+    Storage in a local directory, same interface as GCS storage, to run
+    and benchmark pipeline without network. Files are copied in parallel
+    parts like GCS uploads are, and appear only when complete.
+    """
+
+    def __init__(self, root, dest = "", nof_parts = 1):
+        self.path = os.path.join(root, dest)
+        self.nof_parts = nof_parts
+        os.makedirs(self.path, exist_ok=True)
+
+    def target(self, name):
+        return os.path.join(self.path, name)
+
+    def upload_file(self, fname, name, nof_parts = None, part_size = PART_SIZE):
+        """
+        Copy file into the storage in parallel parts, as many as configured if nof_parts is None
+
+        returns: int
+            number of bytes uploaded
+        """
+
+        if nof_parts is None:
+            nof_parts = self.nof_parts
+
+        size = os.path.getsize(fname)
+        dst  = self.target(name)
+        tmp  = dst + ".part"
+
+        src_fd = os.open(fname, os.O_RDONLY)
+        dst_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(dst_fd, size)
+
+            def copy(part):
+                offset, length = part
+                while length > 0:
+                    buf = os.pread(src_fd, min(length, UPLOAD_CHUNK), offset)
+                    if not buf:
+                        raise OSError("Unexpected end of {0}".format(fname))
+                    os.pwrite(dst_fd, buf, offset)
+                    offset += len(buf)
+                    length -= len(buf)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers = nof_parts) as executor:
+                list(executor.map(copy, split_parts(size, part_size)))
+        finally:
+            os.close(src_fd)
+            os.close(dst_fd)
+
+        os.replace(tmp, dst)
+        return size
+
+    def open_upload(self, name, nof_parts = None):
+        """
+        Open writable stream to the storage, object appears on close
+        """
+        return LocalWriter(self.target(name))
+
+    def list(self, prefix = ""):
+        """
+        Return names of objects with prefix
+        """
+        return sorted(q for q in os.listdir(self.path) if q.startswith(prefix) and not q.endswith(".part"))
+
+
+class LocalWriter:
+    """
+    Writable stream into a temporary file, renamed into place on close
+    """
+
+    def __init__(self, dst):
+        self.dst = dst
+        self.f   = open(dst + ".part", "wb")
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+            os.replace(self.dst + ".part", self.dst)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.f.close()
+            os.remove(self.dst + ".part")
+        else:
+            self.close()
+
+
+def gcs_client(key):
+    """
+    Return GCS client for the service account key file, made once per process
+    """
+    from google.cloud import storage as gcs
+
+    with _lock:
+        if key not in _clients:
+            _clients[key] = gcs.Client.from_service_account_json(key)
+        return _clients[key]
+
+
+class GCSStorage:
+    """
+    Google Cloud Storage bucket. Large files and parallel streams are
+    uploaded as part objects at once and composed into the target.
+    """
+
+    def __init__(self, key, bucket, dest = "", nof_parts = 1):
+        self.bucket    = gcs_client(key).bucket(bucket)
+        self.dest      = dest
+        self.nof_parts = nof_parts
+
+    def blob_name(self, name):
+        return os.path.join(self.dest, name)
+
+    def compose(self, name, parts):
+        """
+        Compose part objects into the target and remove them
+        """
+
+        blob = self.bucket.blob(self.blob_name(name))
+        blob.compose(parts[:COMPOSE_MAX])
+
+        # a compose call takes at most 32 sources, so append the rest to the target in groups
+        for k in range(COMPOSE_MAX, len(parts), COMPOSE_MAX - 1):
+            blob.compose([blob] + parts[k:k + COMPOSE_MAX - 1])
+
+        for part in parts:
+            part.delete()
+
+        return blob
+
+    def upload_file(self, fname, name, nof_parts = None, part_size = PART_SIZE):
+        """
+        Upload file, in parallel parts if it is larger than a part,
+        as many at once as configured if nof_parts is None
+
+        returns: int
+            number of bytes uploaded
+        """
+
+        if nof_parts is None:
+            nof_parts = self.nof_parts
+
+        size = os.path.getsize(fname)
+
+        if size <= part_size or nof_parts <= 1:
+            self.bucket.blob(self.blob_name(name)).upload_from_filename(fname)
+            return size
+
+        def upload(k, part):
+            offset, length = part
+            blob = self.bucket.blob(self.blob_name("{0}.part{1:05d}".format(name, k)))
+            with open(fname, "rb") as f:
+                f.seek(offset)
+                blob.upload_from_file(f, size = length)
+            return blob
+
+        parts = split_parts(size, part_size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers = nof_parts) as executor:
+            parts = list(executor.map(upload, range(len(parts)), parts))
+
+        self.compose(name, parts)
+        return size
+
+    def open_upload(self, name, nof_parts = None):
+        """
+        Open writable stream to the storage, object appears on close.
+        With one part it is a single resumable upload sent in UPLOAD_CHUNK
+        pieces, with more parts PART_SIZE pieces are uploaded at once and composed.
+        """
+
+        if nof_parts is None:
+            nof_parts = self.nof_parts
+
+        if nof_parts <= 1:
+            return self.bucket.blob(self.blob_name(name)).open("wb", chunk_size = UPLOAD_CHUNK, ignore_flush = True)
+
+        return ComposeWriter(self, name, nof_parts)
+
+    def list(self, prefix = ""):
+        """
+        Return names of objects with prefix
+        """
+        return sorted(os.path.basename(blob.name) for blob in self.bucket.list_blobs(prefix = self.blob_name(prefix)))
+
+
+class ComposeWriter:
+    """
+    Writable stream uploading fixed-size parts in parallel, composed into
+    the target object on close. Memory is bounded by parts in flight.
+    """
+
+    def __init__(self, storage, name, nof_parts = NOF_PARTS, part_size = PART_SIZE):
+        self.storage   = storage
+        self.name      = name
+        self.nof_parts = nof_parts
+        self.part_size = part_size
+        self.executor  = concurrent.futures.ThreadPoolExecutor(max_workers = nof_parts)
+        self.pending   = collections.deque()
+        self.parts     = list()
+        self.buf       = bytearray()
+
+    def upload(self, k, data):
+        blob = self.storage.bucket.blob(self.storage.blob_name("{0}.part{1:05d}".format(self.name, k)))
+        blob.upload_from_string(data)
+        return blob
+
+    def submit(self):
+        k = len(self.parts) + len(self.pending)
+        self.pending.append(self.executor.submit(self.upload, k, bytes(self.buf)))
+        self.buf = bytearray()
+        while len(self.pending) > self.nof_parts:
+            self.parts.append(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) >= self.part_size:
+            self.submit()
+        return len(data)
+
+    def close(self):
+        if self.buf or not (self.parts or self.pending):
+            self.submit()
+        while self.pending:
+            self.parts.append(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.storage.compose(self.name, self.parts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown()
+
+
+def benchmark(storage, fname, configs):
+    """
+    Upload file with every configuration, measuring throughput
+
+    Parameters
+    ------------
+
+    storage: LocalStorage or GCSStorage
+        where to upload
+
+    fname: string
+        file to upload
+
+    configs: list of dictionaries
+        nof_parts and part_size to try
+
+    returns: list of dictionaries
+        configuration with wall time, bytes and MB/sec
+    """
+
+    results = list()
+    for cfg in configs:
+        start = time.time()
+        size  = storage.upload_file(fname, "bench_" + os.path.basename(fname), cfg["nof_parts"], cfg["part_size"])
+        elapsed = time.time() - start
+
+        r = dict(cfg)
+        r.update({"seconds": elapsed, "bytes": size, "MB/sec": size / elapsed / 1.0e6 if elapsed > 0 else 0.0})
+        results.append(r)
+
+    return results
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args < 4 or sys.argv[1] != "bench":
+        print("Use: storage bench <storage config JSON> <file to upload>")
+        sys.exit(1)
+
+    storage = open_storage(sys.argv[2])
+
+    configs = [{"nof_parts": n, "part_size": PART_SIZE} for n in (1, 2, 4, 8, 16)]
+    for r in benchmark(storage, sys.argv[3], configs):
+        print(json.dumps(r))
+
+    sys.exit(0)
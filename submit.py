@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import json
+import time
+import subprocess
+import concurrent.futures
+
+import helpers
+
+BATCH_SIZE     = 50  # pods per kubectl call
+NOF_CONCURRENT = 4   # kubectl calls in flight
+NOF_ATTEMPTS   = 5   # attempts per batch
+BACKOFF        = 1.0 # initial delay between attempts, in seconds, doubled each time
+
+# kubectl error output telling an object was refused, e.g. an existing pod with
+# a changed spec, retrying such a call does not help
+OBJECT_ERRORS = ("(Invalid)", "is invalid", "(Forbidden)", "(BadRequest)", "(Conflict)",
+                 "(AlreadyExists)", "field is immutable", "may not change fields")
+
+
+def make_pods(temjson, cases, docker2run, mcpu = None):
+    """
+    Given parsed template, make in-memory pod JSON for every case
+
+    Parameters
+    ------------
+
+    temjson: dictionary
+        In-memory pod JSON template, left intact
+
+    cases: list of strings
+        Cases to compute
+
+    docker2run: string
+        docker image to run
+
+    mcpu: integer
+        CPU request and limit of the pod in millicores, template one if None
+
+    returns: list of dictionaries
+        pods, one per case
+    """
+
+    pods = list()
+    for case in cases:
+        if not case:
+            continue
+
+        pod  = copy.deepcopy(temjson)
+        name = helpers.case2pod(case)
+
+        pod["metadata"]["name"] = name
+        pod["spec"]["containers"][0]["name"]  = name
+        pod["spec"]["containers"][0]["image"] = docker2run
+        pod["spec"]["containers"][0]["args"]  = helpers.case2args(case)
+
+        if mcpu is not None:
+            cpu = "{0}m".format(mcpu)
+            pod["spec"]["containers"][0]["resources"] = {"requests": {"cpu": cpu}, "limits": {"cpu": cpu}}
+
+        pods.append(pod)
+
+    return pods
+
+
+def make_batches(items, batch_size):
+    """
+    Split list into batches of at most batch_size items
+    """
+    return [items[k:k + batch_size] for k in range(0, len(items), batch_size)]
+
+
+def apply_pods(pods):
+    """
+    Apply pods with a single kubectl call
+
+    Parameters
+    ------------
+
+    pods: list of dictionaries
+        pods to apply
+
+    returns: tuple
+        return code, set of names of pods applied and kubectl error output
+    """
+
+    data = json.dumps({"apiVersion": "v1", "kind": "List", "items": pods}).encode("utf-8")
+
+    r = subprocess.run(["kubectl", "apply", "-o", "name", "-f", "-"], input = data,
+                       stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+
+    applied = set(line[len("pod/"):] for line in r.stdout.decode("utf-8", "replace").split() if line.startswith("pod/"))
+
+    return r.returncode, applied, r.stderr.decode("utf-8", "replace").strip()
+
+
+def submit_batch(pods, nof_attempts = NOF_ATTEMPTS, backoff = BACKOFF):
+    """
+    Submit batch of pods with a single kubectl call, retrying with exponential backoff
+
+    Pods are applied rather than created, so retrying a partially
+    submitted batch does not fail on the pods which already exist.
+    Only pods not applied yet are retried, and only while the whole call
+    fails, e.g. the API server is unreachable. Pods refused while others
+    got through are applied one by one to tell which failed and why.
+
+    Parameters
+    ------------
+
+    pods: list of dictionaries
+        pods to submit
+
+    nof_attempts: integer
+        number of attempts
+
+    backoff: float
+        initial delay between attempts, in seconds
+
+    returns: dictionary
+        name to kubectl error output of every pod which failed to submit
+    """
+
+    remaining = pods
+
+    err = ""
+    retried_out = True
+    delay = backoff
+    for k in range(0, nof_attempts):
+        rc, applied, err = apply_pods(remaining)
+        remaining = [pod for pod in remaining if pod["metadata"]["name"] not in applied]
+        if not remaining or applied or any(q in err for q in OBJECT_ERRORS):
+            retried_out = False
+            break
+
+        if k + 1 < nof_attempts:
+            time.sleep(delay)
+            delay *= 2.0
+
+    if retried_out or len(remaining) == 1:
+        return {pod["metadata"]["name"]: err for pod in remaining}
+
+    failed = dict()
+    for pod in remaining:
+        rc, applied, err = apply_pods([pod])
+        if pod["metadata"]["name"] not in applied:
+            failed[pod["metadata"]["name"]] = err
+
+    return failed
+
+
+def submit_pods(pods, batch_size = BATCH_SIZE, nof_concurrent = NOF_CONCURRENT):
+    """
+    Submit pods in batches with bounded concurrency
+
+    Parameters
+    ------------
+
+    pods: list of dictionaries
+        pods to submit
+
+    batch_size: integer
+        pods per kubectl call
+
+    nof_concurrent: integer
+        maximum number of kubectl calls in flight
+
+    returns: dictionary
+        name to kubectl error output of every pod which failed to submit
+    """
+
+    batches = make_batches(pods, batch_size)
+
+    failed = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers = nof_concurrent) as executor:
+        for batch_failed in executor.map(submit_batch, batches):
+            failed.update(batch_failed)
+
+    return failed
+
+
+def submit_cases(template, cases, docker2run, mcpu = None, batch_size = BATCH_SIZE, nof_concurrent = NOF_CONCURRENT):
+    """
+    Read template once and submit a pod per case in bulk
+
+    Parameters
+    ------------
+
+    template: string
+        file name of the JSON template
+
+    cases: list of strings
+        Cases to compute
+
+    docker2run: string
+        docker image to run
+
+    mcpu: integer
+        CPU request and limit of the pod in millicores, template one if None
+
+    returns: dictionary
+        name to kubectl error output of every pod which failed to submit
+    """
+
+    with open(template) as data_file:
+        temjson = json.load(data_file)
+
+    pods = make_pods(temjson, cases, docker2run, mcpu)
+
+    return submit_pods(pods, batch_size, nof_concurrent)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import numpy as np
+
+import main
+import phsf
+import archive
+
+BATCH = 65536 # records generated and written at once
+
+# share of photons, electrons and positrons among records
+MIX = (0.90, 0.095, 0.005)
+
+# Geant4 log lines interleaved with records
+NOISE = [ "G4WT{t} > --------------------End of Global Run-----------------------\n",
+          "G4WT{t} > ### Run 0 starts on worker thread {t}.\n",
+          "G4WT{t} > --> Event {n} starts with initial seeds (12345,67890).\n",
+          "G4WT{t} >  G4ParticleChange::CheckIt : the Momentum Change is not unit vector !!\n",
+          "G4WT{t} > Checking overlaps for volume Collimator ... OK! \n",
+          "G4WT{t} > WARNING - Attempt to delete the physical volume store while geometry closed !\n" ]
+
+LINE_FMT = "G4WT{0} > {1} " + " ".join(["{%d:.6e}" % k for k in range(2, 9)]) + "\n"
+
+
+def make_records(rng, n, tag):
+    """
+    Make n particle records with plausible phase-space distributions:
+    Co-60 lines and scatter continuum for photons, soft spectrum for
+    charged particles, gaussian spot in the scoring plane, forward directions
+
+    returns: numpy array
+        records, 2D with phsf.FIELDS as columns
+    """
+
+    a = np.empty((n, len(phsf.FIELDS)), dtype=np.float64)
+
+    if tag == "GGG":
+        e = rng.uniform(0.01, 1.3325, n)
+        lines = rng.random(n) < 0.3
+        e[lines] = rng.choice([1.1732, 1.3325], lines.sum())
+    else:
+        e = np.minimum(rng.exponential(0.3, n), 1.3)
+    a[:, 0] = e
+
+    a[:, 1] = rng.normal(0.0, 20.0, n)
+    a[:, 2] = rng.normal(0.0, 20.0, n)
+    a[:, 3] = 200.0
+
+    wz  = rng.uniform(0.9, 1.0, n)
+    phi = rng.uniform(0.0, 2.0*np.pi, n)
+    st  = np.sqrt(1.0 - wz*wz)
+    a[:, 4] = st * np.cos(phi)
+    a[:, 5] = st * np.sin(phi)
+    a[:, 6] = wz
+
+    return a
+
+
+def make_lines(rng, n, nof_threads = 1, noise = 0.1):
+    """
+    Make n record lines mixed with Geant4 log noise, as the application prints them
+
+    Parameters
+    ----------
+
+    rng: numpy.random.Generator
+        random generator
+
+    n: integer
+        number of records
+
+    nof_threads: integer
+        number of worker threads prefixing lines
+
+    noise: float
+        log lines per record
+
+    returns: tuple
+        text, and numbers of photons, electrons and positrons in it
+    """
+
+    kinds   = rng.choice(len(phsf.PARTICLES), n, p=MIX)
+    threads = rng.integers(0, nof_threads, n)
+
+    records = np.empty((n, len(phsf.FIELDS)), dtype=np.float64)
+    counts  = list()
+    for k, (name, tag) in enumerate(phsf.PARTICLES):
+        sel = kinds == k
+        records[sel] = make_records(rng, int(sel.sum()), tag)
+        counts.append(int(sel.sum()))
+
+    tags  = [tag for name, tag in phsf.PARTICLES]
+    lines = [LINE_FMT.format(t, tags[k], *r) for t, k, r in zip(threads.tolist(), kinds.tolist(), records.tolist())]
+
+    # noise goes after random records
+    nof_noise = rng.binomial(n, noise) if noise > 0.0 else 0
+    for pos, which, t in zip(rng.integers(0, n, nof_noise).tolist(), rng.integers(0, len(NOISE), nof_noise).tolist(), rng.integers(0, nof_threads, nof_noise).tolist()):
+        lines[pos] += NOISE[which].format(t=t, n=pos)
+
+    return "".join(lines), counts
+
+
+def write_output(fname, nof_records, nof_threads = 1, noise = 0.1, seed = 1):
+    """
+    Write synthetic .output file
+
+    returns: list of integers
+        numbers of photons, electrons and positrons written
+    """
+
+    rng = np.random.default_rng(seed)
+
+    total = [0, 0, 0]
+    with open(fname, "w") as f:
+        f.write("\n        ################################\n        !!! G4Backtrace is activated !!!\n        ################################\n\n")
+        for start in range(0, nof_records, BATCH):
+            text, counts = make_lines(rng, min(BATCH, nof_records - start), nof_threads, noise)
+            f.write(text)
+            total = [q + c for q, c in zip(total, counts)]
+        f.write("G4WT0 > Run terminated.\n")
+
+    return total
+
+
+def make_run(dir_name, nof_records, C = 25, nof_tracks = 1000000, nof_threads = 2, seed = (1, 1),
+             app = "col", mac = "batchGP5.mac", noise = 0.1, codec = "xz", level = 6):
+    """
+    Make synthetic run archive named and signed like main.main does
+
+    Parameters
+    ----------
+
+    dir_name: string
+        where to put the archive
+
+    nof_records: integer
+        number of particle records in the output
+
+    returns: tuple
+        archive name, output size in bytes and numbers of photons, electrons and positrons
+    """
+
+    output = os.path.join(dir_name, main.make_output_name(app, mac, C, nof_tracks, nof_threads, seed))
+    counts = write_output(output, nof_records, nof_threads, noise, seed[0] * 1000003 + seed[1])
+    size   = os.path.getsize(output)
+
+    name = output + archive.SUFFIXES[codec]
+    with open(name, "wb") as f:
+        archive.stream_archive(f, [output], codec, level)
+    os.remove(output)
+
+    return os.path.basename(name), size, counts
+
+
+def make_runs(dir_name, nof_runs, nof_records, C = 25, nof_tracks = 1000000, nof_threads = 2, codec = "xz", level = 6):
+    """
+    Make synthetic run archives with distinct seeds
+
+    returns: list of tuples
+        archive name, output size in bytes and numbers of photons, electrons and positrons
+    """
+
+    os.makedirs(dir_name, exist_ok=True)
+
+    return [make_run(dir_name, nof_records, C, nof_tracks, nof_threads, (k + 1, 2*k + 1), codec = codec, level = level)
+            for k in range(nof_runs)]
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args < 4:
+        print("Use: synth <dir> <number of runs> <records per run> [xz|zstd|none]")
+        sys.exit(1)
+
+    codec = sys.argv[4] if nof_args > 4 else "xz"
+
+    for name, size, counts in make_runs(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), codec = codec):
+        print("{0}: {1} bytes, {2}".format(name, size, counts))
+
+    sys.exit(0)
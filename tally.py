@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import tarfile
+
+import numpy as np
+
+import phsf
+import archive
+
+# default binning as (low, high, number of bins), energy in MeV, positions in mm
+BINS = { "e":  (0.0, 1.5, 150),
+         "x":  (-50.0, 50.0, 100),
+         "y":  (-50.0, 50.0, 100),
+         "wz": (-1.0, 1.0, 200) }
+
+BATCH = 65536 # records parsed and histogrammed at once
+
+SUFFIX = ".tally.npz"
+
+
+def make_edges(cfg = None):
+    """
+    Make bin edges from (low, high, number of bins) triplets
+
+    Parameters
+    ----------
+
+    cfg: dictionary
+        binning overriding BINS, might be None
+
+    returns: dictionary
+        axis name to array of bin edges
+    """
+
+    bins = dict(BINS)
+    if cfg is not None:
+        bins.update({k: v for k, v in cfg.items() if k in BINS})
+
+    return {k: np.linspace(lo, hi, int(n) + 1) for k, (lo, hi, n) in bins.items()}
+
+
+class Tally:
+    """
+    Per particle histograms of energy, position in the scoring plane and
+    direction, filled from Geant4 output as it streams. Tallies with the
+    same binning are merged by adding them up.
+    """
+
+    def __init__(self, edges, keep_records = True):
+        self.edges = edges
+        self.keep_records = keep_records
+
+        self.tags = [(name, tag, tag.encode("ascii")) for name, tag in phsf.PARTICLES]
+
+        self.counts = dict()
+        for name, tag, btag in self.tags:
+            self.counts[name + "_n"]    = np.zeros(1, dtype=np.int64)
+            self.counts[name + "_esum"] = np.zeros(1, dtype=np.float64)
+            self.counts[name + "_e"]    = np.zeros(len(edges["e"]) - 1, dtype=np.float64)
+            self.counts[name + "_xy"]   = np.zeros((len(edges["x"]) - 1, len(edges["y"]) - 1), dtype=np.float64)
+            self.counts[name + "_wz"]   = np.zeros(len(edges["wz"]) - 1, dtype=np.float64)
+
+        self.rest  = b""
+        self.lines = {name: list() for name, tag, btag in self.tags}
+
+    def fill(self, name, a):
+        """
+        Add records to the histograms of the particle
+
+        Parameters
+        ----------
+
+        name: string
+            particle name, photons, electrons or positrons
+
+        a: numpy array
+            records, structured with phsf.FIELDS, or 2D with fields as columns
+        """
+
+        if a.dtype.names is not None:
+            e, x, y, wz = a["e"], a["x"], a["y"], a["wz"]
+        else:
+            e, x, y, wz = a[:, 0], a[:, 1], a[:, 2], a[:, 6]
+
+        self.counts[name + "_n"]    += len(e)
+        self.counts[name + "_esum"] += e.sum()
+        self.counts[name + "_e"]    += np.histogram(e, bins=self.edges["e"])[0]
+        self.counts[name + "_xy"]   += np.histogram2d(x, y, bins=(self.edges["x"], self.edges["y"]))[0]
+        self.counts[name + "_wz"]   += np.histogram(wz, bins=self.edges["wz"])[0]
+
+    def flush_lines(self, limit = 0):
+        """
+        Histogram buffered record lines of particles having more than limit of them
+        """
+
+        for name, tag, btag in self.tags:
+            lines = self.lines[name]
+            if len(lines) > limit:
+                self.fill(name, phsf.parse_lines(lines, tag))
+                self.lines[name] = list()
+
+    def feed(self, chunk):
+        """
+        Tally records in the chunk of output as it comes
+
+        Parameters
+        ----------
+
+        chunk: bytes
+            piece of Geant4 stdout, lines might be split between chunks
+
+        returns: bytes
+            what to write to the output, all of it or only non-record lines
+        """
+
+        data = self.rest + chunk
+        cut  = data.rfind(b"\n") + 1
+        self.rest = data[cut:]
+
+        out = list()
+        for line in data[:cut].splitlines(True):
+            for name, tag, btag in self.tags:
+                if btag in line:
+                    self.lines[name].append(line)
+                    break
+            else:
+                if not self.keep_records:
+                    out.append(line)
+
+        self.flush_lines(BATCH)
+
+        return data[:cut] if self.keep_records else b"".join(out)
+
+    def close(self):
+        """
+        Tally what is left, returns what is left to write to the output
+        """
+
+        out = self.feed(b"\n") if self.rest else b""
+        self.flush_lines()
+        return out
+
+    def merge(self, other):
+        """
+        Add other tally with the same binning to this one
+        """
+
+        for k, v in other.edges.items():
+            if not np.array_equal(self.edges[k], v):
+                raise ValueError("Different binning of {0}".format(k))
+
+        for k in self.counts:
+            self.counts[k] += other.counts[k]
+
+    def save(self, fname):
+        """
+        Save tally as compressed NumPy archive
+        """
+
+        arrays = {"edges_" + k: v for k, v in self.edges.items()}
+        arrays.update(self.counts)
+        with open(fname, "wb") as f:
+            np.savez_compressed(f, **arrays)
+
+
+def load(fileobj):
+    """
+    Load tally saved by Tally.save
+
+    Parameters
+    ----------
+
+    fileobj: string or file object
+        tally file
+
+    returns: Tally
+        tally
+    """
+
+    with np.load(fileobj) as data:
+        edges = {k[len("edges_"):]: data[k] for k in data.files if k.startswith("edges_")}
+        t = Tally(edges)
+        for k in t.counts:
+            t.counts[k] = data[k].copy()
+
+    return t
+
+
+def read_archive(full_name):
+    """
+    Read tally shipped in the run archive
+
+    Parameters
+    ----------
+
+    full_name: string
+        path to the archive with compressed run data
+
+    returns: Tally
+        tally, None if there is none in the archive
+    """
+
+    with archive.open_reader(full_name) as f, tarfile.open(fileobj=f, mode="r|") as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(SUFFIX):
+                return load(io.BytesIO(tar.extractfile(member).read()))
+
+    return None
+
+
+def merge_dir(dir_name):
+    """
+    Merge tallies from all run archives in the directory
+
+    returns: tuple
+        merged tally, None if no tallies, and number of runs merged
+    """
+
+    total = None
+    nof_runs = 0
+    for name in sorted(os.listdir(dir_name)):
+        if archive.codec_of(name) is None:
+            continue
+
+        t = read_archive(os.path.join(dir_name, name))
+        if t is None:
+            continue
+
+        if total is None:
+            total = t
+        else:
+            total.merge(t)
+        nof_runs += 1
+
+    return total, nof_runs
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args < 3:
+        print("Use: tally merged.tally.npz <dir with run archives>")
+        sys.exit(1)
+
+    total, nof_runs = merge_dir(sys.argv[2])
+    if total is None:
+        print("=== No tallies ===")
+        sys.exit(1)
+
+    total.save(sys.argv[1])
+
+    for name, tag in phsf.PARTICLES:
+        print("{0}: {1} in {2} runs".format(name, int(total.counts[name + "_n"][0]), nof_runs))
+
+    sys.exit(0)
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import threading
+import urllib.request
+import http.server
+
+import helpers
+
+LEASE_TIME = 600.0 # seconds a task is held by a worker without renewal
+
+STATES = ("pending", "leased", "done", "failed")
+
+
+class FileQueue:
+    """
+    Work queue kept in a directory, one file per task, with a subdirectory
+    per task state. State changes are atomic renames, so several workers
+    may share the queue. Lease expiry is kept as modification time of the
+    leased file, expired tasks go back to pending on the next lease.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for state in STATES:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def fname(self, state, task_id):
+        return os.path.join(self.path, state, task_id)
+
+    def put(self, cases):
+        """
+        Add cases to the queue, returns number of cases added
+        """
+
+        n = 0
+        for case in cases:
+            if not case:
+                continue
+
+            task_id = helpers.case2name(case)
+            tmp = self.fname("pending", "." + task_id)
+            with open(tmp, "wt") as f:
+                f.write(case)
+            os.replace(tmp, self.fname("pending", task_id))
+            n += 1
+
+        return n
+
+    def reclaim(self):
+        """
+        Return tasks with expired leases to pending, returns number of tasks returned
+        """
+
+        now = time.time()
+        n = 0
+        for task_id in os.listdir(os.path.join(self.path, "leased")):
+            fname = self.fname("leased", task_id)
+            try:
+                if os.path.getmtime(fname) < now:
+                    os.rename(fname, self.fname("pending", task_id))
+                    n += 1
+            except FileNotFoundError:
+                pass # renewed, completed or reclaimed by someone else
+
+        return n
+
+    def lease(self, duration = LEASE_TIME):
+        """
+        Lease next pending task, returns task id and case, None if queue is empty
+        """
+
+        self.reclaim()
+
+        now = time.time()
+        for task_id in sorted(os.listdir(os.path.join(self.path, "pending"))):
+            if task_id.startswith("."):
+                continue
+
+            fname = self.fname("pending", task_id)
+            try:
+                os.utime(fname, (now, now + duration)) # expiry set before it is visible as leased
+                os.rename(fname, self.fname("leased", task_id))
+            except FileNotFoundError:
+                continue # leased by someone else
+
+            with open(self.fname("leased", task_id), "rt") as f:
+                return (task_id, f.read())
+
+        return None
+
+    def renew(self, task_id, duration = LEASE_TIME):
+        """
+        Extend the lease, returns False if the lease is lost
+        """
+
+        now = time.time()
+        try:
+            os.utime(self.fname("leased", task_id), (now, now + duration))
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def finish(self, task_id, state):
+        """
+        Move leased task to the final state, returns False if the lease is lost
+        """
+
+        try:
+            os.rename(self.fname("leased", task_id), self.fname(state, task_id))
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def complete(self, task_id):
+        """
+        Mark leased task as done
+        """
+        return self.finish(task_id, "done")
+
+    def fail(self, task_id):
+        """
+        Mark leased task as failed, it is not retried
+        """
+        return self.finish(task_id, "failed")
+
+    def counts(self):
+        """
+        Returns number of tasks in every state
+        """
+        return {state: len([q for q in os.listdir(os.path.join(self.path, state)) if not q.startswith(".")]) for state in STATES}
+
+
+class HttpQueue:
+    """
+    Client of the work queue served over HTTP by serve()
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def call(self, method, **kwargs):
+        data = json.dumps(kwargs).encode("utf-8")
+        req  = urllib.request.Request(self.url + "/" + method, data=data, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=60) as r:
+            return json.loads(r.read().decode("utf-8"))
+
+    def put(self, cases):
+        return self.call("put", cases=list(cases))
+
+    def lease(self, duration = LEASE_TIME):
+        r = self.call("lease", duration=duration)
+        return tuple(r) if r is not None else None
+
+    def renew(self, task_id, duration = LEASE_TIME):
+        return self.call("renew", task_id=task_id, duration=duration)
+
+    def complete(self, task_id):
+        return self.call("complete", task_id=task_id)
+
+    def fail(self, task_id):
+        return self.call("fail", task_id=task_id)
+
+    def counts(self):
+        return self.call("counts")
+
+
+def open_queue(spec):
+    """
+    Open work queue
+
+    Parameters
+    ------------
+
+    spec: string
+        http(s) URL of the queue server or queue directory
+
+    returns: FileQueue or HttpQueue
+        queue
+    """
+
+    if spec.startswith("http://") or spec.startswith("https://"):
+        return HttpQueue(spec)
+
+    return FileQueue(spec)
+
+
+def make_handler(queue):
+    """
+    Make HTTP request handler serving the queue
+    """
+
+    lock = threading.Lock()
+    methods = {"put", "lease", "renew", "complete", "fail", "counts"}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            method = self.path.strip("/")
+            if method not in methods:
+                self.send_error(404)
+                return
+
+            size   = int(self.headers.get("Content-Length", 0))
+            kwargs = json.loads(self.rfile.read(size).decode("utf-8")) if size > 0 else dict()
+
+            with lock:
+                result = getattr(queue, method)(**kwargs)
+
+            data = json.dumps(result).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(path, port, host = ""):
+    """
+    Serve queue kept in directory over HTTP
+
+    Parameters
+    ------------
+
+    path: string
+        queue directory
+
+    port: integer
+        port to listen on
+
+    host: string
+        address to listen on, all by default
+    """
+
+    server = http.server.ThreadingHTTPServer((host, port), make_handler(FileQueue(path)))
+    server.serve_forever()
+
+
+class Heartbeat:
+    """
+    Renews the lease on a background thread while the task is running
+    """
+
+    def __init__(self, queue, task_id, duration = LEASE_TIME):
+        self.queue    = queue
+        self.task_id  = task_id
+        self.duration = duration
+        self.stopped  = threading.Event()
+        self.thread   = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.duration / 3.0):
+            try:
+                self.queue.renew(self.task_id, self.duration)
+            except OSError:
+                pass # try again on the next beat, lease expires if the queue is gone
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+if __name__ =='__main__':
+    nof_args = len(sys.argv)
+
+    if nof_args < 3:
+        print("Use: workqueue put <queue> cases.txt | serve <queue dir> <port> | counts <queue>")
+        sys.exit(1)
+
+    cmd   = sys.argv[1]
+    spec  = sys.argv[2]
+
+    if cmd == "put":
+        with open(sys.argv[3], "rt") as f:
+            n = open_queue(spec).put([x.strip() for x in f.readlines()])
+        print("Cases added: {0}".format(n))
+    elif cmd == "serve":
+        serve(spec, int(sys.argv[3]))
+    elif cmd == "counts":
+        print(open_queue(spec).counts())
+    else:
+        print("Unknown command {0}".format(cmd))
+        sys.exit(1)
+
+    sys.exit(0)